@@ -0,0 +1,523 @@
+"""Backends storing the request cache, selected with the request_cache_backend config variable."""
+import os
+import json
+import time
+import asyncio
+import heapq
+import sqlite3
+import zlib
+import itertools
+import threading
+from datetime import datetime
+from collections import Counter
+
+from httpx import Request, Response
+
+MEMORY = "memory"
+SQLITE = "sqlite"
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+# Estimated memory used by a cached item apart from its body, its headers and python objects
+ITEM_OVERHEAD_BYTES = 1024
+
+
+def build_response(response, content):
+    """Returns a copy of the response with new content, dropping the headers that describe the original encoding."""
+    headers = [
+        (name, value)
+        for name, value in response.headers.raw
+        if name.lower() not in (b"content-encoding", b"content-length")
+    ]
+    try:
+        request = response.request
+    except RuntimeError:
+        request = None  # Responses that were not made by a client have no request
+    return Response(
+        status_code=response.status_code,
+        headers=headers,
+        content=content,
+        request=request,
+    )
+
+
+class Compressor:
+    """Compresses and decompresses the cached document bodies with zlib, or zstd when `zstandard` is installed."""
+
+    def __init__(self, name):
+        self.name = name
+        if name == ZLIB:
+            self.compress = lambda data: zlib.compress(data, 1)
+            self.decompress = zlib.decompress
+        elif name == ZSTD:
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError(
+                    "request_cache_compression is set to 'zstd' but the `zstandard` package is not installed"
+                )
+            self.compress = zstandard.ZstdCompressor(level=3).compress
+            self.decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            raise ValueError(
+                f"Unknown request_cache_compression '{name}', use '{ZLIB}' or '{ZSTD}'"
+            )
+
+
+class CacheBackend:
+    """The interface a request cache backend implements, mapping a cache_key to a CacheItem."""
+
+    compressor = None
+
+    def get(self, key):
+        """Returns the item cached for the key, None when there is no unexpired item."""
+        raise NotImplementedError
+
+    def set(self, key, item):
+        """Caches the item for the key, replacing any item already cached for it."""
+        raise NotImplementedError
+
+    async def get_async(self, key):
+        """Calls get() from the event loop, backends that block on IO run it in a thread."""
+        return self.get(key)
+
+    async def set_async(self, key, item):
+        """Calls set() from the event loop, backends that block on IO run it in a thread."""
+        self.set(key, item)
+
+    def update(self, key, item):
+        """Saves changes made to an item that was returned by get(), without resetting its age."""
+        raise NotImplementedError
+
+    def flush(self):
+        """Writes any changes the backend is holding in memory."""
+        pass
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns the number of items, the bytes they use and how many items were evicted to stay within budget."""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _split_item(self, item):
+        """Splits an item into a copy without the response body, and the body as it should be stored.
+
+        The decoded text of the body is left out as well, it is decoded again when the item is retrieved.
+        """
+        body = item.response.content
+        if self.compressor is not None:
+            body = self.compressor.compress(body)
+        bodyless_item = item.copy(
+            update={"response": build_response(item.response, b""), "text": None}
+        )
+        item.size_bytes = bodyless_item.size_bytes = len(body) + ITEM_OVERHEAD_BYTES
+        return bodyless_item, body
+
+    def _join_item(self, bodyless_item, body):
+        """Rebuilds an item that was split by _split_item()."""
+        if self.compressor is not None:
+            body = self.compressor.decompress(body)
+        return bodyless_item.copy(
+            update={"response": build_response(bodyless_item.response, body)}
+        )
+
+
+class _MemoryEntry:
+    __slots__ = ["item", "body", "size", "frequency", "priority", "expires_at"]
+
+    def __init__(self, item, body, size, expires_at):
+        self.item = item
+        self.body = body
+        self.size = size
+        self.frequency = 0
+        self.priority = 0
+        self.expires_at = expires_at
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Caches items in this process within a byte budget, the items are not shared with other workers.
+
+    Without compression the items themselves are kept, along with the text they decode their body to, so retrieved
+    items are not decoded again.
+
+    Items are evicted with Greedy-Dual-Size-Frequency, which keeps the items that are retrieved often and are
+    small, while aging out items that were popular a long time ago.
+    """
+
+    def __init__(self, max_len, max_bytes, max_age_seconds, compression=None):
+        self.max_len = max_len
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.compressor = Compressor(compression) if compression else None
+        self.size_bytes = 0
+        self.evictions = 0
+        self._entries = {}
+        # (priority, order, key), entries whose priority has since changed are skipped when popped
+        self._heap = []
+        self._order = itertools.count()
+        self._clock = 0.0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._prioritize(key, entry)
+        if self.compressor is None:
+            return entry.item
+        return self._join_item(entry.item, entry.body)
+
+    def set(self, key, item):
+        if self.compressor is None:
+            body = None
+            # The body is counted twice, once for the text it is decoded to
+            item.size_bytes = 2 * len(item.response.content) + ITEM_OVERHEAD_BYTES
+        else:
+            item, body = self._split_item(item)
+
+        self._remove(key)
+        if item.size_bytes > self.max_bytes:
+            return
+        entry = _MemoryEntry(
+            item, body, item.size_bytes, time.monotonic() + self.max_age_seconds
+        )
+        self._entries[key] = entry
+        self.size_bytes += entry.size
+        self._prioritize(key, entry)
+        self._evict(key)
+
+    def update(self, key, item):
+        entry = self._entries.get(key)
+        if entry is not None and self.compressor is not None:
+            # Keep the bodyless copy, with the changes made to the item
+            entry.item = item.copy(
+                update={"response": entry.item.response, "text": None}
+            )
+
+    def delete(self, key):
+        self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._heap = []
+        self.size_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _prioritize(self, key, entry):
+        entry.frequency += 1
+        entry.priority = self._clock + entry.frequency / entry.size
+        heapq.heappush(self._heap, (entry.priority, next(self._order), key))
+        if len(self._heap) > 4 * len(self._entries) + 64:
+            self._heap = [
+                (cached_entry.priority, next(self._order), cached_key)
+                for cached_key, cached_entry in self._entries.items()
+            ]
+            heapq.heapify(self._heap)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry.size
+
+    def _evict(self, new_key):
+        """Evicts items until the cache is within budget, never the item with new_key that was just set."""
+        if self.size_bytes <= self.max_bytes and len(self._entries) <= self.max_len:
+            return
+
+        # Expired items go first
+        now = time.monotonic()
+        for key in [
+            key for key, entry in self._entries.items() if entry.expires_at <= now
+        ]:
+            self._remove(key)
+
+        new_item = None
+        while self._heap and (
+            self.size_bytes > self.max_bytes or len(self._entries) > self.max_len
+        ):
+            priority, order, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry.priority != priority:
+                continue
+            if key == new_key:
+                new_item = (priority, order, key)
+                continue
+            self._clock = priority
+            self._remove(key)
+            self.evictions += 1
+        if new_item is not None:
+            heapq.heappush(self._heap, new_item)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Caches items in a SQLite database in WAL mode, so that every worker on the host shares one cache.
+
+    Each field of an item is stored in its own column, the headers as JSON text and the body as a BLOB, so reading
+    the database never runs code from it. The directory of the database is created readable only by its owner.
+
+    When the cache is over budget, the items with the fewest retrievals for their size are evicted first. Retrievals
+    are counted in memory and written every hits_flush_seconds, rather than taking the write lock on every hit, and
+    stats() returns the figures from the last write so it never blocks.
+    """
+
+    hits_flush_seconds = 5
+
+    # Columns holding the fields of a CacheItem, apart from its body
+    ITEM_COLUMNS = (
+        "status_code",
+        "headers",
+        "url",
+        "created_datetime",
+        "hits",
+        "document_id",
+        "etag",
+        "last_modified",
+        "encoding",
+    )
+
+    def __init__(self, path, max_len, max_bytes, max_age_seconds, compression=None):
+        self.max_len = max_len
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.compressor = Compressor(compression) if compression else None
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._hits_lock = threading.Lock()
+        self._pending_hits = Counter()  # Retrievals by key that are not written yet
+        self._flushed_at = time.monotonic()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cached_responses ("
+            "key TEXT PRIMARY KEY, status_code INTEGER NOT NULL, headers TEXT NOT NULL, url TEXT, "
+            "created_datetime TEXT NOT NULL, hits INTEGER NOT NULL, document_id TEXT NOT NULL, etag TEXT, "
+            "last_modified TEXT, encoding TEXT, body BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._stats = {}
+        self._update_stats()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    @staticmethod
+    def _item_values(item):
+        """Returns the values of the ITEM_COLUMNS for an item."""
+        try:
+            url = str(item.response.request.url)
+        except RuntimeError:
+            url = None  # Responses that were not made by a client have no request
+        headers = [
+            [name.decode("latin-1"), value.decode("latin-1")]
+            for name, value in item.response.headers.raw
+            if name.lower() not in (b"content-encoding", b"content-length")
+        ]
+        return (
+            item.response.status_code,
+            json.dumps(headers),
+            url,
+            item.created_datetime.isoformat(),
+            item.retrieved_count,
+            item.document_id,
+            item.etag,
+            item.last_modified,
+            item.encoding,
+        )
+
+    def _item_from_row(self, key, row):
+        """Rebuilds an item from the ITEM_COLUMNS and the body of a row."""
+        from .util import CacheItem
+
+        (
+            status_code,
+            headers,
+            url,
+            created_datetime,
+            hits,
+            document_id,
+            etag,
+            last_modified,
+            encoding,
+            body,
+        ) = row
+        if self.compressor is not None:
+            body = self.compressor.decompress(body)
+        response = Response(
+            status_code=status_code,
+            headers=[tuple(header) for header in json.loads(headers)],
+            content=body,
+            request=Request("GET", url) if url else None,
+        )
+        return CacheItem(
+            response=response,
+            created_datetime=datetime.fromisoformat(created_datetime),
+            retrieved_count=hits + self._pending_hits.get(key, 0),
+            document_id=document_id,
+            etag=etag,
+            last_modified=last_modified,
+            encoding=encoding,
+        )
+
+    async def get_async(self, key):
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def set_async(self, key, item):
+        await asyncio.get_running_loop().run_in_executor(None, self.set, key, item)
+
+    def get(self, key):
+        if time.monotonic() - self._flushed_at >= self.hits_flush_seconds:
+            self.flush()
+        rows = self._execute(
+            f"SELECT {', '.join(self.ITEM_COLUMNS)}, body FROM cached_responses "
+            "WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        )
+        if not rows:
+            return None
+        return self._item_from_row(key, rows[0])
+
+    def set(self, key, item):
+        now = time.time()
+        body = item.response.content
+        if self.compressor is not None:
+            body = self.compressor.compress(body)
+        item.size_bytes = len(body) + ITEM_OVERHEAD_BYTES
+        # The row replaces any earlier one, the item's retrieved_count already includes the retrievals pending for it
+        with self._hits_lock:
+            self._pending_hits.pop(key, None)
+        if item.size_bytes > self.max_bytes:
+            self.delete(key)
+            return
+        columns = self.ITEM_COLUMNS + (
+            "key",
+            "body",
+            "size",
+            "created_at",
+            "expires_at",
+        )
+        self._execute(
+            f"INSERT OR REPLACE INTO cached_responses ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            self._item_values(item)
+            + (key, body, item.size_bytes, now, now + self.max_age_seconds),
+        )
+        self._evict(now, key)
+
+    def update(self, key, item):
+        """Counts a retrieval of the item in memory, it is written to the database by the next flush()."""
+        with self._hits_lock:
+            self._pending_hits[key] += 1
+
+    def flush(self):
+        """Writes the retrievals counted since the last flush, and updates the figures returned by stats()."""
+        with self._hits_lock:
+            pending_hits, self._pending_hits = self._pending_hits, Counter()
+            self._flushed_at = time.monotonic()
+        if pending_hits:
+            with self._lock:
+                self._connection.executemany(
+                    "UPDATE cached_responses SET hits = hits + ? WHERE key = ?",
+                    [(hits, key) for key, hits in pending_hits.items()],
+                )
+        self._update_stats()
+
+    def delete(self, key):
+        self._execute("DELETE FROM cached_responses WHERE key = ?", (key,))
+
+    def clear(self):
+        self._execute("DELETE FROM cached_responses")
+        self._update_stats()
+
+    def stats(self):
+        return {**self._stats, "evictions": self.evictions}
+
+    def _update_stats(self):
+        entries, size_bytes = self._execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cached_responses"
+        )[0]
+        self._stats = {"entries": entries, "bytes": size_bytes}
+
+    def __len__(self):
+        return self._execute(
+            "SELECT COUNT(*) FROM cached_responses WHERE expires_at > ?",
+            (time.time(),),
+        )[0][0]
+
+    def _evict(self, now, new_key):
+        """Evicts items until the cache is within budget, never the item with new_key that was just set."""
+        self._execute("DELETE FROM cached_responses WHERE expires_at <= ?", (now,))
+        rows = self._execute(
+            "SELECT key, size FROM cached_responses ORDER BY key = ? DESC, (hits + 1.0) / size DESC",
+            (new_key,),
+        )
+        # Keep the new item, then the most valuable items that fit in the budget
+        evict_keys = []
+        kept_count = kept_bytes = 0
+        for key, size in rows:
+            if kept_count < self.max_len and kept_bytes + size <= self.max_bytes:
+                kept_count += 1
+                kept_bytes += size
+            else:
+                evict_keys.append((key,))
+        if evict_keys:
+            with self._lock:
+                self._connection.executemany(
+                    "DELETE FROM cached_responses WHERE key = ?", evict_keys
+                )
+            self.evictions += len(evict_keys)
+        self._update_stats()
+
+
+def create_backend(settings):
+    """Creates the cache backend selected in the settings.
+
+    Items are kept past their max age for request_cache_revalidate_seconds so they can be revalidated, and for at
+    least request_cache_stale_seconds so they can be served while they are refreshed.
+    """
+    max_age_seconds = settings.request_cache_max_age_seconds + max(
+        settings.request_cache_revalidate_seconds,
+        settings.request_cache_stale_seconds,
+    )
+    if settings.request_cache_backend == SQLITE:
+        return SQLiteCacheBackend(
+            path=settings.request_cache_sqlite_path,
+            max_len=settings.request_cache_max_len,
+            max_bytes=settings.request_cache_max_bytes,
+            max_age_seconds=max_age_seconds,
+            compression=settings.request_cache_compression,
+        )
+    elif settings.request_cache_backend == MEMORY:
+        return MemoryCacheBackend(
+            max_len=settings.request_cache_max_len,
+            max_bytes=settings.request_cache_max_bytes,
+            max_age_seconds=max_age_seconds,
+            compression=settings.request_cache_compression,
+        )
+    raise ValueError(
+        f"Unknown request_cache_backend '{settings.request_cache_backend}', use '{MEMORY}' or '{SQLITE}'"
+    )
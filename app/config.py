@@ -1,3 +1,5 @@
+import os
+
 from pydantic import BaseSettings, AnyUrl
 
 
@@ -20,9 +22,82 @@ class Settings(BaseSettings):
     request_cache_max_len: int = (
         50  # Number of items that can be stored in the request cache
     )
+    request_cache_max_bytes: int = (
+        64 * 1024 * 1024  # Number of bytes the request cache may use
+    )
+    request_cache_compression: str = (
+        None  # Compress cached documents with "zlib", or "zstd" which requires the optional `zstandard` package
+    )
     request_cache_max_age_seconds: int = (
         60  # Number of seconds a cached request should survive
     )
+    request_cache_revalidate_seconds: int = (
+        3600  # Number of seconds an expired cached request is kept to be revalidated with its ETag or Last-Modified
+    )
+    request_cache_stale_seconds: int = (
+        30  # Number of seconds an expired cached request is still served for, while it is refreshed in the background
+    )
+    request_cache_refresh_min_retrievals: int = (
+        5  # Retrievals after which a cached request is refreshed in the background before it expires, 0 to never
+    )
+    request_cache_refresh_ahead_seconds: int = (
+        10  # Number of seconds before a cached request with enough retrievals expires that it is refreshed
+    )
+    request_cache_backend: str = (
+        "memory"  # "memory" for a cache per worker, or "sqlite" for a cache shared by every worker on the host
+    )
+    request_cache_sqlite_path: str = os.path.join(
+        os.path.expanduser("~"), ".cache", "parsel_selector_api", "cache.sqlite3"
+    )  # Database file used by the "sqlite" request cache backend, in a directory created for the app
+
+    batch_max_paths: int = (
+        100  # Number of paths that can be sent in a single batch request
+    )
+    bulk_max_urls: int = 500  # Number of urls that can be sent in a single bulk request
+    bulk_max_concurrency: int = (
+        10  # Number of urls in a bulk request that are fetched at the same time
+    )
+
+    document_cache_max_bytes: int = (
+        64 * 1024 * 1024  # Estimated memory the cache of parsed documents may use
+    )
+    document_cache_size_multiplier: int = (
+        5  # Estimated size of a parsed document as a multiple of its raw size
+    )
+
+    compiled_path_cache_max_len: int = (
+        256  # Number of compiled XPath, CSS, regex and dpath paths that are kept
+    )
+    css_node_index: bool = (
+        True  # Answer simple CSS selectors on cached documents from an index of their ids, classes and tags
+    )
+
+    parse_executor: str = (
+        "thread"  # Where large documents are parsed: "thread", "process" or "none" to parse in the event loop
+    )
+    parse_executor_workers: int = 4  # Number of threads or processes parsing documents
+    parse_inline_max_bytes: int = (
+        256 * 1024  # Documents smaller than this are parsed in the event loop
+    )
+
+    request_max_bytes: int = (
+        50 * 1024 * 1024  # Largest document that will be downloaded, 0 for no limit, raise it to stream larger feeds
+    )
+    upstream_http2: bool = (
+        False  # Negotiate HTTP/2 with upstream hosts, requires the optional `h2` package
+    )
+    upstream_max_connections: int = (
+        100  # Total number of open connections the shared upstream client may hold
+    )
+    upstream_max_keepalive_connections: int = (
+        20  # Number of idle connections kept alive for reuse
+    )
+    upstream_keepalive_expiry_seconds: float = (
+        30  # Number of seconds an idle connection is kept alive
+    )
+    upstream_max_connections_per_host: int = (
+        10  # Number of concurrent requests allowed to a single host, 0 for no limit
+    )
 
 
 settings = Settings()
@@ -1,9 +1,20 @@
-from app import config
-from app.util import CacheItem
+from app import config, metrics
+from app.util import (
+    CacheItem,
+    cache,
+    json_dumps,
+    RAW_DATA_FULL,
+    RAW_DATA_NONE,
+    RAW_DATA_TRUNCATE,
+    RAW_DATA_RANGE,
+    RAW_DATA_MATCH,
+)
 from enum import Enum
+from typing import Dict
 from datetime import datetime, timedelta
 
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, validator
 
 # TODO get rid of this trash, this should be in BaseResponse and ReturnStyles.make_basic() should be removed.
 basic_format_keys = ["request_error", "path_data", "used_cache"]
@@ -37,6 +48,43 @@ class ReturnStyles(str, Enum):
         return sector_data
 
 
+class RawDataModes(str, Enum):
+    """Valid options for the raw_data_mode of a request, how much of the document a VERBOSE response returns."""
+
+    FULL = RAW_DATA_FULL
+    NONE = RAW_DATA_NONE
+    TRUNCATE = RAW_DATA_TRUNCATE
+    RANGE = RAW_DATA_RANGE
+    MATCH = RAW_DATA_MATCH
+
+
+class FastJSONResponse(JSONResponse):
+    """A JSON response encoded with orjson.
+
+    Routes return the content of their response model as a dict in this response, so FastAPI does not build and
+    validate the response model again.
+    """
+
+    def render(self, content):
+        self.timings = {}
+        with metrics.timer("serialize", self.timings):
+            return json_dumps(content)
+
+
+def server_timing(parser, response):
+    """Returns a Server-Timing header value with the time spent in each stage of the request, and the document size."""
+    timings = {**parser.timings, **getattr(response, "timings", {})}
+    profile = parser.profile
+    entries = [
+        f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items()
+    ]
+    if profile["document_bytes"] is not None:
+        entries.append(f'document_bytes;desc="{profile["document_bytes"]}"')
+    if profile["node_count"] is not None:
+        entries.append(f'node_count;desc="{profile["node_count"]}"')
+    return ", ".join(entries)
+
+
 class RequestError(BaseModel):
     code: int
     msg: list
@@ -52,6 +100,11 @@ class CacheInfo(BaseModel):
     age: timedelta
     time_remaining: timedelta
     retrieved_count: int
+    stale: bool = False
+    size_bytes: int = None
+    cache_entries: int = None
+    cache_bytes: int = None
+    cache_evictions: int = None
 
     class Config:
         offset = timedelta(seconds=35)
@@ -64,19 +117,37 @@ class CacheInfo(BaseModel):
                 )
                 - offset,
                 "retrieved_count": 1,
+                "stale": False,
+                "size_bytes": 1536,
+                "cache_entries": 12,
+                "cache_bytes": 1048576,
+                "cache_evictions": 0,
             }
         }
 
-    @classmethod
-    def from_cached_item(cls, cached_item):
+    @staticmethod
+    def content_from_cached_item(cached_item, stale=False):
+        """Returns the fields of a CacheInfo for the cached item as a dict, without building the model."""
         if not cached_item:
             return None
-        return cls(
-            original_request_time=cached_item.created_datetime,
-            age=cached_item.age,
-            time_remaining=cached_item.time_remaining,
-            retrieved_count=cached_item.retrieved_count,
-        )
+        cache_stats = cache.stats()
+        return {
+            "original_request_time": cached_item.created_datetime,
+            "age": cached_item.age,
+            "time_remaining": cached_item.time_remaining,
+            "retrieved_count": cached_item.retrieved_count,
+            "stale": stale,
+            "size_bytes": cached_item.size_bytes,
+            "cache_entries": cache_stats["entries"],
+            "cache_bytes": cache_stats["bytes"],
+            "cache_evictions": cache_stats["evictions"],
+        }
+
+
+class Profile(BaseModel):
+    timings_ms: Dict[str, float]
+    document_bytes: int = None
+    node_count: int = None
 
 
 class BaseResponse(BaseModel):
@@ -86,24 +157,37 @@ class BaseResponse(BaseModel):
     cache_info: CacheInfo = None
     path_data: str = None
     raw_data: str = None
+    raw_data_sourceline: int = None
+    profile: Profile = None
 
     basic_format_keys = basic_format_keys
 
     @classmethod
-    def from_parser(
+    def content_from_parser(
         cls,
         request_item,
         parser,
     ):
-        return cls(
-            request_item=request_item,
-            request_error=RequestError(code=parser.status_code, msg=parser.status_msg),
-            parser_error=ParserError(code=parser.error_code, msg=parser.error_msg),
-            path_data=parser.path_data,
-            raw_data=parser.raw_data,
-            used_cache=True if parser.cached_item else False,
-            cache_info=CacheInfo.from_cached_item(parser.cached_item),
-        )
+        """Returns the content of the response as a dict for a FastJSONResponse, in the requested return_style."""
+        content = {
+            "request_error": {"code": parser.status_code, "msg": parser.status_msg},
+            "used_cache": True if parser.cached_item else False,
+            "path_data": parser.path_data,
+        }
+        if request_item.return_style == ReturnStyles.VERBOSE:
+            raw_data, raw_data_sourceline = parser.raw_data_selection()
+            content.update(
+                parser_error={"code": parser.error_code, "msg": parser.error_msg},
+                cache_info=CacheInfo.content_from_cached_item(
+                    parser.cached_item, parser.stale
+                ),
+                raw_data=raw_data,
+                raw_data_sourceline=raw_data_sourceline,
+                request_item=request_item,
+            )
+        if request_item.profile:
+            content["profile"] = parser.profile
+        return content
 
     def as_basic(self):
         """Remove the keys that we do not want in a 'basic' formatted version of a SelectorData model"""
@@ -112,3 +196,97 @@ class BaseResponse(BaseModel):
             if key not in self.basic_format_keys:
                 del return_data[key]
         return return_data
+
+
+class BaseBatchRequest(BaseModel):
+    """Fields shared by the batch requests, subclasses define the `paths` field with their own path types."""
+
+    pretty: bool = False
+
+    @validator("paths", check_fields=False)
+    def validate_paths(cls, paths):
+        if len(paths) > config.settings.batch_max_paths:
+            raise ValueError(
+                f"A batch request may contain at most {config.settings.batch_max_paths} paths"
+            )
+        names = [path_item.name for path_item in paths]
+        if len(names) != len(set(names)):
+            raise ValueError("Each path in a batch request must have a unique name")
+        return paths
+
+
+class BaseBulkRequest(BaseModel):
+    """Fields shared by the bulk requests, subclasses define the `urls` field."""
+
+    pretty: bool = False
+
+    @validator("urls", check_fields=False)
+    def validate_urls(cls, urls):
+        if len(urls) > config.settings.bulk_max_urls:
+            raise ValueError(
+                f"A bulk request may contain at most {config.settings.bulk_max_urls} urls"
+            )
+        return urls
+
+
+class BulkResult(BaseModel):
+    """A single line of the NDJSON returned by the bulk endpoints."""
+
+    url: str
+    request_error: RequestError = None
+    parser_error: ParserError
+    used_cache: bool = False
+    path_data: str = None
+
+    @staticmethod
+    def content_from_parser(parser):
+        """Returns the fields of a BulkResult for the parser as a dict, without building the model."""
+        return {
+            "url": parser.url,
+            "request_error": (
+                {"code": parser.status_code, "msg": parser.status_msg}
+                if parser.request is not None
+                else None
+            ),
+            "parser_error": {"code": parser.error_code, "msg": parser.error_msg},
+            "used_cache": True if parser.cached_item else False,
+            "path_data": parser.path_data,
+        }
+
+
+class BatchPathResult(BaseModel):
+    parser_error: ParserError
+    path_data: str = None
+
+
+class BaseBatchResponse(BaseModel):
+    request_error: RequestError
+    used_cache: bool = False
+    cache_info: CacheInfo = None
+    results: Dict[str, BatchPathResult]
+
+    @staticmethod
+    def content_from_parsers(
+        request_item,
+        parser,
+        path_parsers,
+    ):
+        """Returns the content of the response as a dict for a FastJSONResponse."""
+        return {
+            "request_item": request_item,
+            "request_error": {"code": parser.status_code, "msg": parser.status_msg},
+            "used_cache": True if parser.cached_item else False,
+            "cache_info": CacheInfo.content_from_cached_item(
+                parser.cached_item, parser.stale
+            ),
+            "results": {
+                name: {
+                    "parser_error": {
+                        "code": path_parser.error_code,
+                        "msg": path_parser.error_msg,
+                    },
+                    "path_data": path_parser.path_data,
+                }
+                for name, path_parser in path_parsers.items()
+            },
+        }
@@ -1,17 +1,16 @@
 from fastapi import FastAPI
-from fastapi.responses import ORJSONResponse
-import sentry_sdk
-from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 
-from .util import user_agents
-from .routers import dpath, parsel, examples
-from . import config
-
-# Initiate sentry.io logging
-sentry_sdk.init(
-    dsn=config.settings.sentry_dsn,
-    environment=config.settings.env,
+from .util import (
+    user_agents,
+    upstream,
+    parse_executor,
+    cache,
+    document_cache,
+    add_data_response_examples,
 )
+from .routers import dpath, parsel, examples
+from . import config, metrics
 
 tags_metadata = [
     {
@@ -41,13 +40,91 @@ app.include_router(dpath.router)
 app.include_router(parsel.router)
 app.include_router(examples.router)
 
-try:
-    app.add_middleware(SentryAsgiMiddleware)
-except Exception:
-    # pass silently if the Sentry integration failed
-    print(
-        f"Sentry integration failed, sentry_dsn config variable set to: {config.settings.env}"
-    )
+
+def openapi():
+    """Generates the OpenAPI schema when the docs first ask for it, along with the example responses of the parsers."""
+    if app.openapi_schema is None:
+        add_data_response_examples(
+            app.routes,
+            {
+                "/dpath": dpath.dpath_verbose_example,
+                "/parsel": parsel.parsel_verbose_example,
+            },
+        )
+    return FastAPI.openapi(app)
+
+
+app.openapi = openapi
+
+
+class SentryMiddleware:
+    """ASGI middleware that initiates sentry.io logging and wraps the app in the Sentry middleware when it starts.
+
+    sentry_sdk is only imported once the first lifespan event or request arrives, rather than when the app is
+    imported, and not at all when sentry_dsn is not set.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.sentry_app = None
+
+    async def __call__(self, scope, receive, send):
+        if self.sentry_app is None:
+            self.sentry_app = self.init_sentry()
+        return await self.sentry_app(scope, receive, send)
+
+    def init_sentry(self):
+        if not config.settings.sentry_dsn:
+            return self.app
+        try:
+            import sentry_sdk
+            from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
+
+            sentry_sdk.init(
+                dsn=config.settings.sentry_dsn,
+                environment=config.settings.env,
+            )
+            return SentryAsgiMiddleware(self.app)
+        except Exception:
+            # pass silently if the Sentry integration failed
+            print(
+                f"Sentry integration failed, sentry_dsn config variable set to: {config.settings.sentry_dsn}"
+            )
+            return self.app
+
+
+app.add_middleware(metrics.InFlightMiddleware)
+app.add_middleware(SentryMiddleware)
+
+
+@app.on_event("startup")
+async def open_upstream_client():
+    """Open the shared upstream client so connections are reused between requests."""
+    await upstream.start()
+
+
+@app.on_event("startup")
+async def start_parse_executor():
+    """Start the pool that large documents are parsed in."""
+    parse_executor.start()
+
+
+@app.on_event("shutdown")
+async def close_upstream_client():
+    """Close the shared upstream client and any connections it is keeping alive."""
+    await upstream.close()
+
+
+@app.on_event("shutdown")
+async def flush_request_cache():
+    """Write the cache retrievals that are still counted in memory."""
+    cache.flush()
+
+
+@app.on_event("shutdown")
+async def close_parse_executor():
+    """Shut down the pool that large documents are parsed in."""
+    parse_executor.close()
 
 
 @app.get("/user_agents", response_class=ORJSONResponse, tags=["Extras"])
@@ -60,3 +137,33 @@ async def get_user_agents_list():
 async def get_user_agents():
     """An endpoint to wake the API up when the server is asleep on services like Heroku."""
     return True
+
+
+@app.get("/stats", response_class=ORJSONResponse, tags=["Extras"])
+async def get_stats():
+    """Returns counters describing the work this instance of the API has done since it started, and the size of its caches."""
+    return {
+        "counters": dict(metrics.counters),
+        "request_cache": cache.stats(),
+        "document_cache": {
+            "entries": len(document_cache),
+            "bytes": document_cache.size_bytes,
+        },
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Extras"])
+async def get_metrics():
+    """Returns the counters, in flight gauges and per stage timings of this instance of the API in the Prometheus text format, for a local Prometheus server to scrape."""
+    cache_stats = cache.stats()
+    return PlainTextResponse(
+        metrics.render_prometheus(
+            extra_gauges={
+                "request_cache_entries": cache_stats["entries"],
+                "request_cache_bytes": cache_stats["bytes"],
+                "document_cache_entries": len(document_cache),
+                "document_cache_bytes": document_cache.size_bytes,
+            }
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,169 @@
+"""Counters, gauges and stage timers describing the work the API is doing, reported by /stats and /metrics."""
+
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+counters = Counter()
+
+# Values that go up and down, like the number of requests in flight
+gauges = Counter()
+
+# Upper bounds in seconds of the buckets durations are counted in
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+DESCRIPTIONS = {
+    "stage_duration_seconds": "Time spent in each stage of handling a request.",
+    "http_request_duration_seconds": "Time spent handling a request, by route handler.",
+    "http_requests_in_flight": "Requests that are currently being handled.",
+    "upstream_requests_in_flight": "Upstream requests that are currently being made.",
+}
+
+# Histograms keyed by (name, labels)
+durations = {}
+_lock = threading.Lock()  # Counters are incremented and stages timed in the parse thread pool too
+
+
+class Histogram:
+    """Counts durations in the DURATION_BUCKETS, along with their count and sum."""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for index, upper_bound in enumerate(DURATION_BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+def increment(name, value=1):
+    """Increment the counter with the given name."""
+    with _lock:
+        counters[name] += value
+
+
+def observe(name, seconds, **labels):
+    """Records a duration in the histogram with the given name and labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = durations.get(key)
+        if histogram is None:
+            histogram = durations[key] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextmanager
+def timer(stage, timings=None):
+    """Times the stage of handling a request that runs within the block.
+
+    The seconds are also added to the stage in the timings dict when one is passed, to profile a single request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe("stage_duration_seconds", seconds, stage=stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def in_flight(name):
+    """Counts the block in the gauge with the given name while it runs."""
+    gauges[name] += 1
+    try:
+        yield
+    finally:
+        gauges[name] -= 1
+
+
+class InFlightMiddleware:
+    """ASGI middleware that counts the requests in flight, and times each request by the handler of its route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        try:
+            with in_flight("http_requests_in_flight"):
+                await self.app(scope, receive, send)
+        finally:
+            # The router adds the endpoint to the scope once the request is routed
+            endpoint = scope.get("endpoint")
+            observe(
+                "http_request_duration_seconds",
+                time.perf_counter() - start,
+                handler=getattr(endpoint, "__name__", "none"),
+            )
+
+
+def _format_labels(labels, **extra_labels):
+    labels = list(labels) + list(extra_labels.items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def render_prometheus(extra_gauges=None):
+    """Returns the counters, gauges and histograms in the Prometheus text exposition format.
+
+    extra_gauges are values measured when the metrics are collected, like the size of the caches.
+    """
+    lines = []
+    with _lock:
+        counter_values = sorted(counters.items())
+    for name, value in counter_values:
+        lines.append(f"# TYPE {name}_total counter")
+        lines.append(f"{name}_total {value}")
+
+    for name, value in sorted({**gauges, **(extra_gauges or {})}.items()):
+        if name in DESCRIPTIONS:
+            lines.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    with _lock:
+        histograms = sorted(
+            (key, list(histogram.bucket_counts), histogram.count, histogram.sum)
+            for key, histogram in durations.items()
+        )
+    described = set()
+    for (name, labels), bucket_counts, count, total in histograms:
+        if name not in described:
+            described.add(name)
+            if name in DESCRIPTIONS:
+                lines.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+            lines.append(f"# TYPE {name} histogram")
+        for upper_bound, bucket_count in zip(DURATION_BUCKETS, bucket_counts):
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, le=upper_bound)} {bucket_count}"
+            )
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
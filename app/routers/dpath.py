@@ -1,23 +1,33 @@
 import json
 from enum import Enum
 
-import xmltodict
-import dpath.util
 from pydantic import BaseModel, AnyUrl
-from typing import Union
+from typing import Union, List
 from fastapi import APIRouter, Depends
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 
-from .. import config
+from .. import config, streaming
 from .examples import DocumentExamples
-from ..dependencies import ReturnStyles, BaseResponse, CacheInfo
+from ..dependencies import (
+    ReturnStyles,
+    RawDataModes,
+    BaseResponse,
+    CacheInfo,
+    FastJSONResponse,
+    server_timing,
+    BaseBatchRequest,
+    BaseBatchResponse,
+    BaseBulkRequest,
+    BulkResult,
+)
 from ..util import (
-    get_data_response_examples,
     JSON,
     XML,
     default_user_agent,
     BaseDocumentParser,
-    get_data_response_examples,
+    run_bulk,
+    json_dumps,
+    compiled_paths,
 )
 
 router = APIRouter()
@@ -30,6 +40,13 @@ class DpathPathTypes(str, Enum):
     XML = XML
 
 
+class DpathXmlModes(str, Enum):
+    """Valid xml_mode options for a DpathRequest, how an XML document is searched."""
+
+    XMLTODICT = "xmltodict"
+    LXML = "lxml"
+
+
 class DpathRequest(BaseModel):
     """Model reporesenting the request a user can send."""
 
@@ -38,6 +55,14 @@ class DpathRequest(BaseModel):
     path_type: DpathPathTypes = DpathPathTypes.JSON
     user_agent = default_user_agent
     return_style: ReturnStyles = ReturnStyles.BASIC
+    pretty: bool = False
+    profile: bool = False
+    streaming: bool = False
+    xml_mode: DpathXmlModes = DpathXmlModes.XMLTODICT
+    raw_data_mode: RawDataModes = RawDataModes.FULL
+    raw_data_length: int = 1000
+    raw_data_start: int = 0
+    raw_data_end: int = None
 
     class Config:
         schema_extra = {
@@ -51,31 +76,214 @@ class DpathRequest(BaseModel):
         }
 
 
+class DpathBatchPath(BaseModel):
+    """A single named path in a DpathBatchRequest."""
+
+    name: str
+    path: str
+    path_type: DpathPathTypes = DpathPathTypes.JSON
+
+
+class DpathBatchRequest(BaseBatchRequest):
+    """Model representing a request for many paths in the same document."""
+
+    url: AnyUrl
+    paths: List[DpathBatchPath]
+    user_agent = default_user_agent
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "url": f"{config.settings.site_url}/examples/json",
+                "paths": [
+                    {"name": "subject", "path": "/note/subject", "path_type": JSON},
+                    {"name": "body", "path": "/note/body", "path_type": JSON},
+                ],
+                "user_agent": default_user_agent,
+            }
+        }
+
+
+class DpathBulkRequest(BaseBulkRequest):
+    """Model representing a request for the same path in many documents."""
+
+    urls: List[AnyUrl]
+    path: str
+    path_type: DpathPathTypes = DpathPathTypes.JSON
+    user_agent = default_user_agent
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "urls": [
+                    f"{config.settings.site_url}/examples/json",
+                    f"{config.settings.site_url}/examples/json?page=2",
+                ],
+                "path": "/note/subject",
+                "path_type": JSON,
+                "user_agent": default_user_agent,
+            }
+        }
+
+
+def compile_dpath(path):
+    """Splits a path into the segments dpath globs against, the same way dpath.util.get() does for a string path."""
+    if path == "/":
+        return path  # dpath.util.get() returns the whole document for "/"
+    segments = []
+    for segment in path.lstrip("/").split("/"):
+        try:
+            segments.append(int(segment))
+        except ValueError:
+            segments.append(segment)
+    return tuple(segments)
+
+
+class DpathLookup:
+    """A compiled path, that gets the data at the path from a document.
+
+    Paths without globs walk the document directly by key and index, only paths with globs are matched by dpath.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = compile_dpath(path)
+        self.is_literal = not streaming.GLOB_CHARACTERS.search(path)
+        self.keys = () if path == "/" else tuple(path.lstrip("/").split("/"))
+
+    def __call__(self, document):
+        if not self.is_literal:
+            import dpath.util
+
+            # dpath formats the glob into its error messages, which only works for a string
+            return dpath.util.get(document, self.path)
+        for key in self.keys:
+            if isinstance(document, dict):
+                document = document[key]
+            elif (
+                isinstance(document, list)
+                and key.isdigit()
+                and int(key) < len(document)
+            ):
+                document = document[int(key)]
+            else:
+                raise KeyError(key)
+        return document
+
+
+class XPathLookup:
+    """A path compiled to XPath, that gets the data at the path from an lxml tree in the form xmltodict would give it.
+
+    Only the `*` glob is supported, integer segments select the nth element with the name before it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_text = path.endswith("/#text")
+        from lxml import etree
+
+        steps = []
+        for segment in [] if path == "/" else compile_dpath(path):
+            if isinstance(segment, int):
+                if not steps or steps[-1].startswith(("/@", "/text()")):
+                    raise ValueError(f"Index {segment} does not follow an element name")
+                steps[-1] += f"[{segment + 1}]"
+            elif segment == "*":
+                steps.append("/*")
+            elif segment == "#text":
+                steps.append("/text()")
+            elif streaming.GLOB_CHARACTERS.search(segment) or "'" in segment:
+                raise ValueError(f"'{segment}' is not supported with the lxml xml_mode")
+            elif segment.startswith("@"):
+                steps.append(f"/@*[name()='{segment[1:]}']")
+            else:
+                # Match the name with its prefix the way xmltodict names it, rather than by namespace
+                steps.append(f"/*[name()='{segment}']")
+        self.xpath = etree.XPath("".join(steps) or "/*", smart_strings=False)
+
+    def __call__(self, root):
+        if self.path == "/":
+            name = streaming.qualified_name(root)
+            return {name: streaming.element_to_dict(root, name)}
+
+        results = self.xpath(root)
+        if not results:
+            raise KeyError(self.path)
+        if self.is_text:
+            return "".join(results)
+        values = [
+            (
+                result
+                if isinstance(result, str)
+                else streaming.element_to_dict(result, streaming.qualified_name(result))
+            )
+            for result in results
+        ]
+        return values[0] if len(values) == 1 else values
+
+
 class DpathDocumentParser(BaseDocumentParser):
     """Parsing logic to extract data from a document using Dpath"""
 
+    streaming = False
+    xml_mode = DpathXmlModes.XMLTODICT
+
     def _get_path_data(self):
         """Gets the path content based on the type of path that was requested"""
+        import xmltodict
+        from lxml import etree
+
         data = None
         try:
-            if self.path_type == self.JSON:
-                json_dict = json.loads(
-                    self.raw_data
+            if self.streaming and streaming.is_streamable(self.path):
+                # Find the data without loading the whole document
+                segments = compiled_paths.get(
+                    self.path_type, self.path, DpathLookup
+                ).segments
+                if self.path_type == self.JSON:
+                    data = streaming.json_get(
+                        self.request.content, segments, self.encoding
+                    )
+                elif self.path_type == self.XML:
+                    data = streaming.xml_get(self.request.content, segments)
+            elif self.path_type == self.JSON:
+                json_dict = self._get_document(
+                    "json", lambda: json.loads(self.raw_data)
                 )  # Convert JSON to python dictionary
-                data = dpath.util.get(
-                    json_dict, self.path
+                data = compiled_paths.get(self.JSON, self.path, DpathLookup)(
+                    json_dict
                 )  # Get the content of the dictionary based on the path provided
+            elif self.path_type == self.XML and self.xml_mode == DpathXmlModes.LXML:
+                try:
+                    root = self._get_document(
+                        "lxml",
+                        lambda: etree.fromstring(
+                            self.request.content,
+                            etree.XMLParser(resolve_entities=False, huge_tree=True),
+                        ),
+                    )
+                except etree.XMLSyntaxError:
+                    self.error_code = 3
+                    self.error_msg = (
+                        "Error parsing XML data. Are you sure the data is valid XML?"
+                    )
+                    return data
+                data = compiled_paths.get(DpathXmlModes.LXML, self.path, XPathLookup)(
+                    root
+                )
             elif self.path_type == self.XML:
                 # Convert the xml into a valid python dictionary so we can parse it the same way we parse JSON
                 try:
-                    xml_dict = xmltodict.parse(self.raw_data)
+                    xml_dict = self._get_document(
+                        "xmltodict", lambda: xmltodict.parse(self.raw_data)
+                    )
                 except Exception:
                     self.error_code = 3
                     self.error_msg = (
                         "Error parsing XML data. Are you sure the data is valid XML?"
                     )
                     return data
-                data = dpath.util.get(xml_dict, self.path)
+                data = compiled_paths.get(self.XML, self.path, DpathLookup)(xml_dict)
         except KeyError:
             self.error_code = 1
             self.error_msg = f"Path error, please enter a valid Path value for the type '{self.path_type}'"
@@ -86,6 +294,13 @@ class DpathDocumentParser(BaseDocumentParser):
             )
         return data.strip() if type(data) == str else data
 
+    @classmethod
+    def from_request_item(cls, request_item):
+        parser = super().from_request_item(request_item)
+        parser.streaming = request_item.streaming
+        parser.xml_mode = request_item.xml_mode
+        return parser
+
 
 class DpathResponse(BaseResponse):
     """Response object returning data to the client"""
@@ -93,6 +308,12 @@ class DpathResponse(BaseResponse):
     request_item: DpathRequest
 
 
+class DpathBatchResponse(BaseBatchResponse):
+    """Response object returning the data for each path in a batch request to the client"""
+
+    request_item: DpathBatchRequest
+
+
 # Example data to process and show as examples of the output that can be returned to the client.
 dpath_verbose_example = {
     "request_item": DpathRequest.Config.schema_extra["example"],
@@ -107,7 +328,6 @@ dpath_verbose_example = {
 
 @router.get(
     "/dpath",
-    responses=get_data_response_examples(dpath_verbose_example),
     response_model=DpathResponse,
     tags=["Parsers"],
 )
@@ -129,22 +349,107 @@ async def parse_data_with_dpath_paths(request_item: DpathRequest = Depends()):
     The XML type converts an XML document with the [xmltodict](https://pypi.org/project/xmltodict/) library:
 
     > `xmltodict` is a Python module that makes working with XML feel like you are working with [JSON](http://docs.python.org/library/json.html), as in this ["spec"](http://www.xml.com/pub/a/2006/05/31/converting-between-xml-and-json.html)
+
+    ### Streaming
+    Set `streaming` to find the data in a large document without loading the whole document into memory, parsing
+    stops as soon as the data at the path has been read. Paths with globs are not streamed. Documents larger than
+    the `request_max_bytes` setting of the server are not downloaded.
+    With XML an element name without an index selects the first element with that name, rather than a list of
+    every element with that name.
+
+    ### XML with lxml
+    Set `xml_mode` to `lxml` to find the data in an XML document with [lxml](https://lxml.de/) instead of converting
+    the whole document with xmltodict. The path is compiled to XPath, so `/a/b` becomes `/a/b` in XPath and
+    `/a/b/0` becomes `/a/b[1]`, while `@name` and `#text` select an attribute and the text of an element. Element
+    names are matched with the namespace prefix used in the document. The data is returned in the same form the
+    xmltodict type returns it, and `*` is the only glob supported.
+
+    ### Raw data
+    Set `raw_data_mode` to choose how much of the document a VERBOSE response returns as its `raw_data`:
+    `FULL` returns the whole document, `NONE` leaves it out, `TRUNCATE` returns the first `raw_data_length`
+    characters, and `RANGE` returns the bytes from `raw_data_start` up to `raw_data_end`. `MATCH` is only supported
+    by the `/parsel` endpoint, and returns no raw data here.
+
+    ### Profiling
+    Set `profile` to get the milliseconds spent in each stage of the request, the size of the document in bytes and
+    the number of nodes in the parsed document in a `profile` field. They are also sent in a `Server-Timing` header,
+    which includes the time spent serializing the response.
     """
 
     # Create a parser object from the request input
     parser = DpathDocumentParser.from_request_item(request_item)
     await parser.run()
 
-    # Create the return object from the retrevied data
-    data = DpathResponse.from_parser(
-        request_item=request_item,
-        parser=parser,
+    if request_item.return_style == ReturnStyles.DATA_ONLY:
+        response = HTMLResponse(parser.path_data)
+    else:
+        # Encode the retrieved data directly, FastAPI does not validate it against the response_model again
+        response = FastJSONResponse(
+            DpathResponse.content_from_parser(
+                request_item=request_item,
+                parser=parser,
+            )
+        )
+
+    if request_item.profile:
+        response.headers["Server-Timing"] = server_timing(parser, response)
+    return response
+
+
+@router.post(
+    "/dpath/batch",
+    response_model=DpathBatchResponse,
+    tags=["Parsers"],
+)
+async def parse_batch_with_dpath(request_item: DpathBatchRequest):
+    """# Dpath Batch
+
+    Get the data at many paths in the same document with a single request. The document is fetched and parsed once,
+    and the result and parser error of each path is returned under the name it was given.
+
+    Paths are written the same way they are for the `/dpath` endpoint.
+    """
+
+    # Fetch the document once, then select the data for each of the paths from it
+    parser = DpathDocumentParser.from_batch_request_item(request_item)
+    path_parsers = await parser.run_paths(request_item.paths)
+
+    return FastJSONResponse(
+        DpathBatchResponse.content_from_parsers(
+            request_item=request_item,
+            parser=parser,
+            path_parsers=path_parsers,
+        )
     )
 
-    # Mutate the return object based on the requested return_style
-    if request_item.return_style == ReturnStyles.BASIC:
-        return data.as_basic()
-    elif request_item.return_style == ReturnStyles.DATA_ONLY:
-        return HTMLResponse(data.path_data)
-    else:
-        return data
+
+@router.post(
+    "/dpath/bulk",
+    response_class=StreamingResponse,
+    tags=["Parsers"],
+)
+async def parse_bulk_with_dpath(request_item: DpathBulkRequest):
+    """# Dpath Bulk
+
+    Get the data at the same path in many documents with a single request. The documents are fetched concurrently,
+    and a line of [NDJSON](http://ndjson.org/) is streamed back for each url as soon as its data is ready, so results
+    are not returned in the order the urls were sent.
+
+    Paths are written the same way they are for the `/dpath` endpoint.
+    """
+    parsers = [
+        DpathDocumentParser(
+            url=url,
+            path=request_item.path,
+            path_type=request_item.path_type,
+            user_agent=request_item.user_agent,
+            pretty=request_item.pretty,
+        )
+        for url in request_item.urls
+    ]
+
+    async def results():
+        async for parser in run_bulk(parsers, config.settings.bulk_max_concurrency):
+            yield json_dumps(BulkResult.content_from_parser(parser)) + b"\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
@@ -1,24 +1,51 @@
+import re
 from enum import Enum
+from typing import List
+from itertools import islice
+from functools import lru_cache
 
-from parsel import Selector
 from pydantic import BaseModel, AnyUrl
 from fastapi import APIRouter, Depends
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 
-from .. import config
+from .. import config, metrics
 from .examples import DocumentExamples
-from ..dependencies import ReturnStyles, BaseResponse, CacheInfo
+from ..dependencies import (
+    ReturnStyles,
+    RawDataModes,
+    BaseResponse,
+    CacheInfo,
+    FastJSONResponse,
+    server_timing,
+    BaseBatchRequest,
+    BaseBatchResponse,
+    BaseBulkRequest,
+    BulkResult,
+)
 from ..util import (
     XPATH,
     CSS,
     REGEX,
+    RAW_DATA_MATCH,
     default_user_agent,
     BaseDocumentParser,
-    get_data_response_examples,
+    run_bulk,
+    json_dumps,
+    compiled_paths,
 )
 
 router = APIRouter()
 
+# A CSS selector for a single id, class or tag, optionally with Parsel's ::text or ::attr() pseudo-elements.
+# Namespaced attributes like xml:lang are left to the tree, which resolves their prefix.
+SIMPLE_CSS_PATTERN = re.compile(
+    r"^\s*([#.]?)(-?[_a-zA-Z][\w-]*)(?:::(text)|::attr\(([\w-]+)\))?\s*$"
+)
+# Class names are separated by the whitespace of XPath's normalize-space(), which cssselect matches classes with.
+# It does not include form feeds or any non-ASCII whitespace.
+CLASS_SEPARATOR = re.compile(r"[ \t\n\r]+")
+SIMPLE_CSS = "SIMPLE_CSS"
+
 
 class ParselPathTypes(str, Enum):
     """Valid path_type options for a ParselRequest path."""
@@ -36,6 +63,15 @@ class ParselRequest(BaseModel):
     path_type: ParselPathTypes = ParselPathTypes.XPATH
     user_agent = default_user_agent
     return_style: ReturnStyles = ReturnStyles.BASIC
+    pretty: bool = False
+    profile: bool = False
+    getall: bool = False
+    limit: int = None
+    offset: int = 0
+    raw_data_mode: RawDataModes = RawDataModes.FULL
+    raw_data_length: int = 1000
+    raw_data_start: int = 0
+    raw_data_end: int = None
 
     class Config:
         schema_extra = {
@@ -49,20 +85,302 @@ class ParselRequest(BaseModel):
         }
 
 
+class ParselBatchPath(BaseModel):
+    """A single named path in a ParselBatchRequest."""
+
+    name: str
+    path: str
+    path_type: ParselPathTypes = ParselPathTypes.XPATH
+
+
+class ParselBatchRequest(BaseBatchRequest):
+    """Model representing a request for many paths in the same document."""
+
+    url: AnyUrl
+    paths: List[ParselBatchPath]
+    user_agent = default_user_agent
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "url": f"{config.settings.site_url}/examples/html",
+                "paths": [
+                    {
+                        "name": "subject",
+                        "path": "/html/body/div/span[3]/text()",
+                        "path_type": XPATH,
+                    },
+                    {
+                        "name": "body",
+                        "path": "div.note > p::text",
+                        "path_type": CSS,
+                    },
+                ],
+                "user_agent": default_user_agent,
+            }
+        }
+
+
+class ParselBulkRequest(BaseBulkRequest):
+    """Model representing a request for the same path in many documents."""
+
+    urls: List[AnyUrl]
+    path: str
+    path_type: ParselPathTypes = ParselPathTypes.XPATH
+    user_agent = default_user_agent
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "urls": [
+                    f"{config.settings.site_url}/examples/html",
+                    f"{config.settings.site_url}/examples/html?page=2",
+                ],
+                "path": "/html/body/div/span[3]/text()",
+                "path_type": XPATH,
+                "user_agent": default_user_agent,
+            }
+        }
+
+
+@lru_cache(maxsize=None)
+def css_translator():
+    """Returns the translator of CSS selectors to XPath, created when the first CSS selector is compiled."""
+    from parsel.csstranslator import HTMLTranslator
+
+    return HTMLTranslator()
+
+
+def compile_xpath(path, smart_strings=False):
+    """Compiles an XPath expression with the same namespaces and options Selector.xpath() uses."""
+    from lxml import etree
+    from parsel import Selector
+
+    try:
+        return etree.XPath(
+            path, namespaces=Selector._default_namespaces, smart_strings=smart_strings
+        )
+    except etree.XPathError as e:
+        raise ValueError(f"XPath error: {e} in {path}")
+
+
+def compile_css(path, smart_strings=False):
+    """Compiles a CSS selector by translating it to XPath, including Parsel's ::text and ::attr() extensions."""
+    return compile_xpath(css_translator().css_to_xpath(path), smart_strings)
+
+
+def compile_source_xpath(path):
+    """Compiles an XPath expression whose string results know the element they were found in."""
+    return compile_xpath(path, smart_strings=True)
+
+
+def compile_source_css(path):
+    """Compiles a CSS selector whose string results know the element they were found in."""
+    return compile_css(path, smart_strings=True)
+
+
+def compile_regex(path):
+    """Compiles a regex the same way Selector.re() does."""
+    return re.compile(path, re.UNICODE)
+
+
+def compile_simple_css(path):
+    """Splits a simple CSS selector, an id, class or tag with an optional ::text or ::attr(), into its parts.
+
+    Returns (kind, name, pseudo_element, attribute), or None for selectors that are not simple.
+    """
+    match = SIMPLE_CSS_PATTERN.match(path)
+    if match is None:
+        return None
+    prefix, name, pseudo_element, attribute = match.groups()
+    kind = {"#": NodeIndex.ID, ".": NodeIndex.CLASS}.get(prefix, NodeIndex.TAG)
+    if kind == NodeIndex.TAG:
+        name = (
+            name.lower()
+        )  # HTMLTranslator lowercases element names, as the HTML parser does
+    return kind, name, pseudo_element, attribute
+
+
+class NodeIndex:
+    """The elements of an HTML document by id, class and tag, built with a single walk of the tree.
+
+    Kept in the parsed document cache alongside the document, so repeated simple CSS selectors on a cached document
+    find their elements without searching the whole tree.
+    """
+
+    ID = "id"
+    CLASS = "class"
+    TAG = "tag"
+
+    def __init__(self, root):
+        from lxml import etree
+
+        self._text_xpath = etree.XPath("text()", smart_strings=False)
+        self._elements = {self.ID: {}, self.CLASS: {}, self.TAG: {}}
+        self._nested = (
+            {}
+        )  # If any of the elements for a key is inside another one, computed when first needed
+        for element in root.iter(etree.Element):
+            self._elements[self.TAG].setdefault(element.tag, []).append(element)
+            element_id = element.get("id")
+            if element_id is not None:
+                self._elements[self.ID].setdefault(element_id, []).append(element)
+            class_names = CLASS_SEPARATOR.split(element.get("class") or "")
+            for class_name in dict.fromkeys(filter(None, class_names)):
+                self._elements[self.CLASS].setdefault(class_name, []).append(element)
+
+    def select(self, kind, name, pseudo_element=None, attribute=None):
+        """Returns the results of the simple selector in document order, None when it has to be run on the tree."""
+        elements = self._elements[kind].get(name, [])
+        if attribute is not None:
+            return [
+                element.get(attribute)
+                for element in elements
+                if element.get(attribute) is not None
+            ]
+        if pseudo_element == "text":
+            # Text nodes are only in document order when none of the elements are inside another one
+            if self._is_nested(kind, name, elements):
+                return None
+            return [text for element in elements for text in self._text_xpath(element)]
+        return elements
+
+    def _is_nested(self, kind, name, elements):
+        key = (kind, name)
+        if key not in self._nested:
+            members = set(elements)
+            self._nested[key] = any(
+                ancestor in members
+                for element in elements
+                for ancestor in element.iterancestors()
+            )
+        return self._nested[key]
+
+
+def iter_regex(regex, text):
+    """Yields the matches of a compiled regex in the text one at a time, the same strings Selector.re() returns."""
+    from parsel.utils import extract_regex
+    from w3lib.html import replace_entities
+
+    if "extract" in regex.groupindex:
+        yield from extract_regex(regex, text)  # Only the first match is extracted
+        return
+    for match in regex.finditer(text):
+        for group in match.groups(default="") if regex.groups else [match.group()]:
+            yield replace_entities(group, keep=["lt", "amp"])
+
+
 class ParselDocumentParser(BaseDocumentParser):
     """Parsing logic to extract data from a document using Parsel Selector"""
 
+    getall = False
+    limit = None
+    offset = 0
+
+    def _path_results(self, selector):
+        """Returns the results of the XPATH or CSS path, the same nodes Selector.xpath() or Selector.css() select.
+
+        Simple CSS selectors on a cached document are answered from its NodeIndex instead of searching the tree.
+        """
+        from lxml import etree
+
+        if self.path_type == self.CSS:
+            results = self._indexed_results(selector)
+            if results is not None:
+                return results
+            xpath = compiled_paths.get(self.CSS, self.path, compile_css)
+        else:
+            xpath = compiled_paths.get(self.XPATH, self.path, compile_xpath)
+        try:
+            result = xpath(selector.root)
+        except etree.XPathError as e:
+            raise ValueError(f"XPath error: {e} in {xpath.path}")
+        return result if type(result) is list else [result]
+
+    def _indexed_results(self, selector):
+        """Returns the results of a simple CSS selector from the NodeIndex, None when the index can not answer it."""
+        if not config.settings.css_node_index or self.document_id is None:
+            return None  # A document that is not cached is only queried once, so searching it is as fast
+        simple_selector = compiled_paths.get(SIMPLE_CSS, self.path, compile_simple_css)
+        if simple_selector is None:
+            return None
+        node_index = self._get_document("node_index", lambda: NodeIndex(selector.root))
+        results = node_index.select(*simple_selector)
+        if results is not None:
+            metrics.increment("node_index_hits")
+        return results
+
+    def matched_raw_data(self):
+        """Returns the outer HTML of the element of the first match and its line, or the text a REGEX matched."""
+        from lxml import etree
+        from parsel import Selector
+
+        if self.path_type == self.REGEX:
+            regex = compiled_paths.get(self.REGEX, self.path, compile_regex)
+            match = regex.search(self.raw_data)
+            if match is None:
+                return None, None
+            return match.group(), self.raw_data.count("\n", 0, match.start()) + 1
+
+        selector = self._get_document("selector", lambda: Selector(text=self.raw_data))
+        if self.path_type == self.XPATH:
+            xpath = compiled_paths.get(
+                f"{RAW_DATA_MATCH}_{self.XPATH}", self.path, compile_source_xpath
+            )
+        else:
+            xpath = compiled_paths.get(
+                f"{RAW_DATA_MATCH}_{self.CSS}", self.path, compile_source_css
+            )
+        result = xpath(selector.root)
+        for match in result if type(result) is list else []:
+            # Text and attribute results are found in their parent element, tail text follows the element it is in
+            element = match.getparent() if isinstance(match, str) else match
+            if isinstance(match, str) and match.is_tail and element is not None:
+                element = element.getparent()
+            if isinstance(element, etree._Element):
+                source = etree.tostring(
+                    element,
+                    method="html" if selector.type == "html" else "xml",
+                    encoding="unicode",
+                    with_tail=False,
+                )
+                return source, element.sourceline
+        return None, None
+
+    def iter_matches(self):
+        """Yields every match of the path in the document, each match is only serialized once it is consumed."""
+        from parsel import Selector
+
+        selector = self._get_document("selector", lambda: Selector(text=self.raw_data))
+        if self.path_type == self.REGEX:
+            regex = compiled_paths.get(self.REGEX, self.path, compile_regex)
+            yield from iter_regex(regex, selector.get())
+            return
+
+        for match in self._path_results(selector):
+            yield Selector(root=match, type=selector.type).get()
+
+    def iter_page(self):
+        """Yields the matches within the requested offset and limit."""
+        offset = max(self.offset, 0)
+        stop = None if self.limit is None else offset + max(self.limit, 0)
+        return islice(self.iter_matches(), offset, stop)
+
     def _get_path_data(self):
         """Gets the path content based on the type of path that was requested"""
+        from parsel import Selector
+
         data = None
         try:
-            selector = Selector(text=self.raw_data)
-            if self.path_type == self.XPATH:
-                data = selector.xpath(self.path).get()
-            elif self.path_type == self.CSS:
-                data = selector.css(self.path).get()
-            elif self.path_type == self.REGEX:
-                data = selector.re(self.path)
+            selector = self._get_document(
+                "selector", lambda: Selector(text=self.raw_data)
+            )
+            if self.getall or self.path_type == self.REGEX:
+                data = list(self.iter_page())
+            elif self.path_type in [self.XPATH, self.CSS]:
+                results = self._path_results(selector)
+                if results:
+                    data = Selector(root=results[0], type=selector.type).get()
         except KeyError:
             self.error_code = 1
             self.error_msg = f"Path error, please enter a valid Path value for the type '{self.path_type}'"
@@ -73,6 +391,14 @@ class ParselDocumentParser(BaseDocumentParser):
             )
         return data.strip() if type(data) == str else data
 
+    @classmethod
+    def from_request_item(cls, request_item):
+        parser = super().from_request_item(request_item)
+        parser.getall = request_item.getall
+        parser.limit = request_item.limit
+        parser.offset = request_item.offset
+        return parser
+
 
 class ParselResponse(BaseResponse):
     """Response object returning data to the client"""
@@ -80,6 +406,12 @@ class ParselResponse(BaseResponse):
     request_item: ParselRequest
 
 
+class ParselBatchResponse(BaseBatchResponse):
+    """Response object returning the data for each path in a batch request to the client"""
+
+    request_item: ParselBatchRequest
+
+
 # Example data to process and show as examples of the output that can be returned to the client.
 parsel_verbose_example = {
     "request_item": ParselRequest.Config.schema_extra["example"],
@@ -94,7 +426,6 @@ parsel_verbose_example = {
 
 @router.get(
     "/parsel",
-    responses=get_data_response_examples(parsel_verbose_example),
     response_model=ParselResponse,
     tags=["Parsers"],
 )
@@ -116,22 +447,137 @@ async def parse_data_with_parsel_selectors(request_item: ParselRequest = Depends
 
     ### REGEX
     With the CSS type, we can use the basic Parsel `Selector.re("some pattern.*")` functionality to get data from an HTML file.
+
+    ### All matches
+    Set `getall` to get a list of every match of an XPATH or CSS path, like `Selector.xpath("/some/path").getall()`,
+    rather than only the first match. Use `offset` and `limit` to get a page of the matches, which also applies to
+    the matches of a REGEX. To get a very large number of matches, use the `/parsel/stream` endpoint.
+
+    ### Raw data
+    Set `raw_data_mode` to choose how much of the document a VERBOSE response returns as its `raw_data`:
+    `FULL` returns the whole document, `NONE` leaves it out, `TRUNCATE` returns the first `raw_data_length`
+    characters, and `RANGE` returns the bytes from `raw_data_start` up to `raw_data_end`. `MATCH` returns the outer
+    HTML of the element of the first match, with the line it starts on in `raw_data_sourceline`. For a REGEX, `MATCH`
+    returns the text of the first match.
+
+    ### Profiling
+    Set `profile` to get the milliseconds spent in each stage of the request, the size of the document in bytes and
+    the number of nodes in the parsed document in a `profile` field. They are also sent in a `Server-Timing` header,
+    which includes the time spent serializing the response.
     """
 
     # Create a parser object from the request input
     parser = ParselDocumentParser.from_request_item(request_item)
     await parser.run()
 
-    # Create the return object from the retrevied data
-    data = ParselResponse.from_parser(
-        request_item=request_item,
-        parser=parser,
+    if request_item.return_style == ReturnStyles.DATA_ONLY:
+        response = HTMLResponse(parser.path_data)
+    else:
+        # Encode the retrieved data directly, FastAPI does not validate it against the response_model again
+        response = FastJSONResponse(
+            ParselResponse.content_from_parser(
+                request_item=request_item,
+                parser=parser,
+            )
+        )
+
+    if request_item.profile:
+        response.headers["Server-Timing"] = server_timing(parser, response)
+    return response
+
+
+@router.get(
+    "/parsel/stream",
+    response_class=StreamingResponse,
+    tags=["Parsers"],
+)
+async def stream_matches_with_parsel(request_item: ParselRequest = Depends()):
+    """# Parsel Stream
+
+    Get every match of a path in the document as [NDJSON](http://ndjson.org/), with a `{"match": ...}` line for each
+    match. Matches are serialized and sent as they are consumed, so the first matches are sent before the rest are
+    serialized, and a response with a very large number of matches is never held in memory.
+
+    Paths are written the same way they are for the `/parsel` endpoint, and `offset` and `limit` select a page of
+    the matches. When the document can not be fetched or the path is not valid, the last line is a
+    `{"parser_error": ...}` line.
+    """
+    parser = ParselDocumentParser.from_request_item(request_item)
+    await parser.fetch()
+
+    def lines():
+        # Run by the StreamingResponse in a thread pool, so parsing does not block the event loop
+        if not parser.error_code:
+            try:
+                for match in parser.iter_page():
+                    yield json_dumps({"match": match}) + b"\n"
+            except Exception as e:
+                parser.error_code = 2
+                parser.error_msg = (
+                    f"There was an error with your Path and Path Type combo: {e}"
+                )
+        if parser.error_code:
+            yield json_dumps(
+                {"parser_error": {"code": parser.error_code, "msg": parser.error_msg}}
+            ) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.post(
+    "/parsel/batch",
+    response_model=ParselBatchResponse,
+    tags=["Parsers"],
+)
+async def parse_batch_with_parsel(request_item: ParselBatchRequest):
+    """# Parsel Batch
+
+    Get the data at many paths in the same document with a single request. The document is fetched and parsed once,
+    and the result and parser error of each path is returned under the name it was given.
+
+    Paths are written the same way they are for the `/parsel` endpoint.
+    """
+
+    # Fetch the document once, then select the data for each of the paths from it
+    parser = ParselDocumentParser.from_batch_request_item(request_item)
+    path_parsers = await parser.run_paths(request_item.paths)
+
+    return FastJSONResponse(
+        ParselBatchResponse.content_from_parsers(
+            request_item=request_item,
+            parser=parser,
+            path_parsers=path_parsers,
+        )
     )
 
-    # Mutate the return object based on the requested return_style
-    if request_item.return_style == ReturnStyles.BASIC:
-        return data.as_basic()
-    elif request_item.return_style == ReturnStyles.DATA_ONLY:
-        return HTMLResponse(data.path_data)
-    else:
-        return data
+
+@router.post(
+    "/parsel/bulk",
+    response_class=StreamingResponse,
+    tags=["Parsers"],
+)
+async def parse_bulk_with_parsel(request_item: ParselBulkRequest):
+    """# Parsel Bulk
+
+    Get the data at the same path in many documents with a single request. The documents are fetched concurrently,
+    and a line of [NDJSON](http://ndjson.org/) is streamed back for each url as soon as its data is ready, so results
+    are not returned in the order the urls were sent.
+
+    Paths are written the same way they are for the `/parsel` endpoint.
+    """
+    parsers = [
+        ParselDocumentParser(
+            url=url,
+            path=request_item.path,
+            path_type=request_item.path_type,
+            user_agent=request_item.user_agent,
+            pretty=request_item.pretty,
+        )
+        for url in request_item.urls
+    ]
+
+    async def results():
+        async for parser in run_bulk(parsers, config.settings.bulk_max_concurrency):
+            yield json_dumps(BulkResult.content_from_parser(parser)) + b"\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
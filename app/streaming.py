@@ -0,0 +1,279 @@
+"""Early exit extraction of a single non-glob path from JSON and XML documents, without building the whole document.
+
+Paths are given as the segments returned by compile_dpath(), integer segments index into JSON arrays and into
+repeated XML elements.
+"""
+
+import re
+import json
+from io import BytesIO, TextIOWrapper
+
+GLOB_CHARACTERS = re.compile(r"[*?\[]")
+
+CHUNK_SIZE = 64 * 1024  # Number of characters of a JSON document decoded at a time
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# The rest of a string after its opening quote, up to the closing quote or an escape cut off by the end of a chunk
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_SCALAR = re.compile(r"[^,}\]\s]+")
+_json_decoder = json.JSONDecoder()
+
+
+def is_streamable(path):
+    """Returns if the data at the path can be found without building the document, paths with globs can not."""
+    return path != "/" and not GLOB_CHARACTERS.search(path)
+
+
+class _JsonReader:
+    """Reads a JSON document from a text stream a chunk at a time, only keeping the text that has not been read.
+
+    The text of a value is kept whole while it is read with read_value(), the text of skipped values is not.
+    """
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.index = 0
+        self.offset = 0  # Position of the text in the document
+        self.keep = None  # Index of the value that is being read, the text after it is not discarded
+        if self.char() == "\ufeff":
+            self.index += 1
+
+    @property
+    def position(self):
+        return self.offset + self.index
+
+    def read_more(self):
+        """Adds the next chunk of the document to the text, returns False at the end of the document."""
+        start = self.index if self.keep is None else self.keep
+        self.text = self.text[start:]
+        self.offset += start
+        self.index -= start
+        if self.keep is not None:
+            self.keep = 0
+        # Reading as much as is kept doubles the text of a long value, so that it is only scanned a few times
+        chunk = self.stream.read(max(self.chunk_size, len(self.text)))
+        self.text += chunk
+        return bool(chunk)
+
+    def char(self):
+        """Returns the character at the index, an empty string at the end of the document."""
+        while self.index >= len(self.text):
+            if not self.read_more():
+                return ""
+        return self.text[self.index]
+
+    def skip_whitespace(self):
+        while True:
+            self.index = _WHITESPACE.match(self.text, self.index).end()
+            if self.index < len(self.text) or not self.read_more():
+                return
+
+    def skip_string(self):
+        start = self.position
+        self.index += 1
+        while True:
+            end = _STRING_BODY.match(self.text, self.index).end()
+            if end < len(self.text) and self.text[end] == '"':
+                self.index = end + 1
+                return
+            self.index = end
+            if not self.read_more():
+                raise ValueError(f"Unterminated string starting at char {start}")
+
+    def skip_scalar(self):
+        while True:
+            match = _SCALAR.match(self.text, self.index)
+            if match is None:
+                raise ValueError(f"Expecting value at char {self.position}")
+            if match.end() < len(self.text) or not self.read_more():
+                self.index = match.end()
+                return
+
+    def skip_value(self):
+        """Moves the index past the JSON value starting at it, without decoding the value."""
+        char = self.char()
+        if not char:
+            raise ValueError(f"Expecting value at char {self.position}")
+        if char == '"':
+            return self.skip_string()
+        if char not in "{[":
+            return self.skip_scalar()
+
+        start = self.position
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(self.text, self.index)
+            if match is None:
+                self.index = len(self.text)
+                if not self.read_more():
+                    raise ValueError(f"Unterminated value starting at char {start}")
+                continue
+            self.index = match.start()
+            char = match.group()
+            if char == '"':
+                self.skip_string()
+                continue
+            self.index += 1
+            if char in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def read_value(self):
+        """Returns the JSON value starting at the index, decoded, and moves the index past it."""
+        self.keep = self.index
+        try:
+            self.skip_value()
+            value, _ = _json_decoder.raw_decode(self.text[self.keep : self.index])
+        finally:
+            self.keep = None
+        return value
+
+    def expect(self, char, name):
+        if self.char() != char:
+            raise ValueError(f"Expecting {name} at char {self.position}")
+        self.index += 1
+        self.skip_whitespace()
+
+    def find_member(self, segment):
+        """Moves the index to the value at the segment, in the JSON object or array starting at the index."""
+        char = self.char()
+        if char == "{":
+            self.expect("{", "'{'")
+            if self.char() == "}":
+                raise KeyError(segment)
+            while True:
+                if self.char() != '"':
+                    raise ValueError(f"Expecting property name at char {self.position}")
+                key = self.read_value()
+                self.skip_whitespace()
+                self.expect(":", "':' delimiter")
+                if key == str(segment):
+                    return
+                self.skip_value()
+                self.skip_whitespace()
+                if self.char() == "}":
+                    raise KeyError(segment)
+                self.expect(",", "',' delimiter")
+        elif char == "[" and isinstance(segment, int) and segment >= 0:
+            self.expect("[", "'['")
+            if self.char() == "]":
+                raise KeyError(segment)
+            for _ in range(segment):
+                self.skip_value()
+                self.skip_whitespace()
+                if self.char() == "]":
+                    raise KeyError(segment)
+                self.expect(",", "',' delimiter")
+            return
+        raise KeyError(segment)
+
+
+def json_get(content, segments, encoding="utf-8"):
+    """Returns the value at the segments of a JSON document, only decoding that value.
+
+    The bytes are decoded a chunk at a time, the members before the value are skipped over without being kept and
+    nothing after it is read.
+    """
+    stream = TextIOWrapper(
+        BytesIO(content), encoding=encoding, errors="replace", newline=""
+    )
+    reader = _JsonReader(stream, CHUNK_SIZE)
+    reader.skip_whitespace()
+    for segment in segments:
+        reader.find_member(segment)
+    return reader.read_value()
+
+
+def _xml_steps(segments):
+    """Splits the segments into element steps of (name, index), and the attribute or text segments that follow them."""
+    steps = []
+    segments = list(segments)
+    while segments and not str(segments[0]).startswith(("@", "#")):
+        name = segments.pop(0)
+        if isinstance(name, int):
+            raise KeyError(name)
+        index = segments.pop(0) if segments and isinstance(segments[0], int) else 0
+        steps.append((name, index))
+    return steps, segments
+
+
+def qualified_name(element):
+    """Returns the name of the element the way xmltodict names it, with its namespace prefix."""
+    from lxml import etree
+
+    name = etree.QName(element).localname
+    return f"{element.prefix}:{name}" if element.prefix else name
+
+
+def element_to_dict(element, name):
+    """Converts an element with xmltodict, leaving out the namespace declarations it inherited from its ancestors."""
+    import xmltodict
+    from lxml import etree
+
+    value = xmltodict.parse(etree.tostring(element))[name]
+    parent = element.getparent()
+    if parent is None or not isinstance(value, dict):
+        return value
+
+    for prefix in parent.nsmap:
+        value.pop(f"@xmlns:{prefix}" if prefix else "@xmlns", None)
+    if not value:
+        return None
+    if list(value) == ["#text"]:
+        return value["#text"]
+    return value
+
+
+def xml_get(content, segments):
+    """Returns the value at the segments of an XML document, in the form xmltodict would give it.
+
+    The document is parsed incrementally, elements that can not contain the value are discarded as soon as they
+    end, and parsing stops once the element at the path has ended. An element name without an index selects the
+    first element with that name.
+    """
+    import dpath.util
+    from lxml import etree
+
+    steps, tail = _xml_steps(segments)
+    if not steps:
+        raise KeyError(segments)
+
+    matched = 0  # Number of steps matched by the open ancestors of the current element
+    depth = 0
+    # Number of elements with the name of the next step that were seen in the deepest matched element
+    sibling_counts = {}
+    for event, element in etree.iterparse(
+        BytesIO(content), events=("start", "end"), resolve_entities=False
+    ):
+        if event == "start":
+            depth += 1
+            if depth == matched + 1 and matched < len(steps):
+                name, index = steps[matched]
+                if qualified_name(element) == name:
+                    seen = sibling_counts.get(matched, 0)
+                    sibling_counts[matched] = seen + 1
+                    if seen == index:
+                        matched += 1
+            continue
+
+        if depth == matched:
+            if matched < len(steps):
+                # The deepest matched element ended without containing the rest of the path
+                raise KeyError(steps[matched][0])
+            value = element_to_dict(element, steps[-1][0])
+            return dpath.util.get(value, tail) if tail else value
+
+        depth -= 1
+        if matched < len(steps):
+            # Discard elements that did not match the path, and the siblings before them
+            element.clear()
+            parent = element.getparent()
+            while parent is not None and element.getprevious() is not None:
+                del parent[0]
+    raise KeyError(steps[0][0])
@@ -1,16 +1,49 @@
+import os
+import sys
 import json
+import asyncio
+import subprocess
 
 import dpath.util
+import httpx
+import pytest
 import xmltodict
+from lxml import etree
 from fastapi.testclient import TestClient
 from parsel import Selector
 
+from . import config, metrics, streaming, util
 from .main import app
+from .cache import SQLiteCacheBackend, MemoryCacheBackend
 from .dependencies import BaseResponse, RequestError, ParserError
-from .routers.dpath import DpathResponse, DpathRequest
-
+from .routers.dpath import (
+    DpathDocumentParser,
+    DpathResponse,
+    DpathRequest,
+    DpathLookup,
+    XPathLookup,
+    compile_dpath,
+)
+from .routers.examples import DocumentExamples
+from .routers.parsel import ParselDocumentParser, ParselRequest
+from .util import (
+    upstream,
+    in_flight,
+    DocumentCache,
+    ParseExecutor,
+    CompiledPathCache,
+    CacheItem,
+    UpstreamClient,
+    DocumentTooLarge,
+)
 
 client = TestClient(app)
+local_upstream_client = httpx.AsyncClient(app=app)
+
+
+def use_local_upstream():
+    """Route the requests the parsers make back into the app, so the example documents can be used without a network."""
+    upstream.client = local_upstream_client
 
 
 def test_wake():
@@ -86,3 +119,899 @@ def test_as_basic():
     basic_format_response_keys = list(response.as_basic()).sort()
     # Assert that after the response is processed, the keys that are returned are only the keys we specified.
     assert basic_format_keys == basic_format_response_keys
+
+
+def test_upstream_client_lifecycle():
+    """Verify that the shared upstream client is opened on startup and closed on shutdown"""
+    with TestClient(app):
+        assert isinstance(upstream.client, httpx.AsyncClient)
+    assert upstream.client is None
+
+
+def test_upstream_host_limit():
+    """Verify that requests to the same host share a connection limit"""
+    assert upstream.host_limit("http://example.com/a") is upstream.host_limit(
+        "http://EXAMPLE.com/b"
+    )
+    assert upstream.host_limit("http://example.com/a") is not upstream.host_limit(
+        "http://example.org/a"
+    )
+
+
+def test_upstream_host_limits_are_removed_when_unused():
+    """Verify that a host's semaphore is only kept while requests to the host hold or wait on it"""
+    upstream_client = UpstreamClient()
+    upstream_client.client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200))
+    )
+
+    async def get_all():
+        return await asyncio.gather(
+            *(
+                upstream_client.get(f"http://host-{index % 50}.test/{index}")
+                for index in range(200)
+            )
+        )
+
+    responses = asyncio.get_event_loop().run_until_complete(get_all())
+    assert all(response.status_code == 200 for response in responses)
+    assert upstream_client._host_semaphores == {}
+    assert not upstream_client._host_users
+    asyncio.get_event_loop().run_until_complete(upstream_client.close())
+
+
+def test_parsel_xpath():
+    use_local_upstream()
+    response = client.get(
+        "/parsel",
+        params={
+            "url": "http://localhost/examples/html",
+            "path": "/html/body/div/span[3]/text()",
+            "path_type": "XPATH",
+            "return_style": "VERBOSE",
+        },
+    )
+    data = response.json()
+    assert data["request_error"]["code"] == 200
+    assert data["path_data"] == DocumentExamples.SUBJECT
+
+
+def test_concurrent_requests_are_coalesced():
+    """Verify that concurrent requests for the same document only make one upstream request"""
+
+    class SlowClient:
+        calls = 0
+
+        async def get(self, url, **kwargs):
+            self.calls += 1
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, content=b"<html></html>")
+
+    async def run_parsers(parsers, slow_client):
+        return await asyncio.gather(*[p._get_response(slow_client) for p in parsers])
+
+    slow_client = SlowClient()
+    parsers = [
+        ParselDocumentParser("http://coalesce.test/page", "//html", "XPATH")
+        for _ in range(5)
+    ]
+    coalesced_count = metrics.counters["coalesced_requests"]
+    responses = asyncio.get_event_loop().run_until_complete(
+        run_parsers(parsers, slow_client)
+    )
+
+    assert slow_client.calls == 1
+    assert all(response is responses[0] for response in responses)
+    assert metrics.counters["coalesced_requests"] == coalesced_count + 4
+    assert sum(parser.coalesced for parser in parsers) == 4
+    assert not in_flight
+
+
+def test_parsed_documents_are_cached():
+    """Verify that a document is only parsed once while its response is cached"""
+    use_local_upstream()
+    params = {
+        "url": "http://localhost/examples/json?parsed_cache",
+        "path_type": "JSON",
+        "return_style": "VERBOSE",
+    }
+    client.get("/dpath", params={**params, "path": "/note/to"})
+    hits = metrics.counters["document_cache_hits"]
+    response = client.get("/dpath", params={**params, "path": "/note/subject"})
+
+    assert metrics.counters["document_cache_hits"] == hits + 1
+    assert response.json()["path_data"] == json.dumps(
+        DocumentExamples.SUBJECT, ensure_ascii=False
+    )
+
+
+def test_document_cache_eviction():
+    """Verify that the document cache stays within its memory budget"""
+    document_cache = DocumentCache(max_bytes=100)
+    document_cache.set("a", "1", "document a", size=60)
+    document_cache.set("b", "1", "document b", size=60)
+
+    assert document_cache.get("a", "1") is None
+    assert document_cache.get("b", "1") == "document b"
+    assert document_cache.get("b", "2") is None
+    assert document_cache.size_bytes == 60
+
+
+def test_parsel_batch():
+    use_local_upstream()
+    response = client.post(
+        "/parsel/batch",
+        json={
+            "url": "http://localhost/examples/html?batch",
+            "paths": [
+                {"name": "subject", "path": "/html/body/div/span[3]/text()"},
+                {"name": "body", "path": "div.note > p::text", "path_type": "CSS"},
+                {"name": "bad", "path": "//[", "path_type": "XPATH"},
+            ],
+        },
+    )
+    data = response.json()
+    assert data["request_error"]["code"] == 200
+    assert data["results"]["subject"]["path_data"] == DocumentExamples.SUBJECT
+    assert data["results"]["body"]["path_data"] == DocumentExamples.BODY
+    assert data["results"]["bad"]["parser_error"]["code"] == 2
+
+
+def test_batch_path_names_must_be_unique():
+    response = client.post(
+        "/dpath/batch",
+        json={
+            "url": "http://localhost/examples/json",
+            "paths": [
+                {"name": "subject", "path": "/note/subject"},
+                {"name": "subject", "path": "/note/body"},
+            ],
+        },
+    )
+    assert response.status_code == 422
+
+
+def test_dpath_bulk():
+    use_local_upstream()
+    urls = [f"http://localhost/examples/json?bulk={page}" for page in range(3)]
+    response = client.post(
+        "/dpath/bulk",
+        json={"urls": urls, "path": "/note/from", "path_type": "JSON"},
+    )
+    results = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert sorted(result["url"] for result in results) == urls
+    assert all(
+        result["path_data"] == json.dumps(DocumentExamples.FROM, indent=2)
+        for result in results
+    )
+
+
+def test_parse_executor(monkeypatch):
+    """Verify that large documents are parsed in a thread or process pool with the same results"""
+    monkeypatch.setattr(config.settings, "parse_inline_max_bytes", 0)
+
+    async def select(executor):
+        parser = ParselDocumentParser(
+            url=None, path="//span[3]/text()", path_type="XPATH"
+        )
+        parser.request = httpx.Response(200, content=DocumentExamples.HTML.encode())
+        data = await executor.get_path_data(parser)
+        executor.close()
+        return data
+
+    for executor_kind in ["thread", "process", "none"]:
+        monkeypatch.setattr(config.settings, "parse_executor", executor_kind)
+        data = asyncio.get_event_loop().run_until_complete(select(ParseExecutor()))
+        assert data == DocumentExamples.SUBJECT
+
+
+def test_compiled_paths_match_parsel():
+    """Verify that selecting with compiled paths returns the same data as Parsel does"""
+    selector = Selector(text=DocumentExamples.HTML)
+    for path_type, path, expected in [
+        ("XPATH", "/html/body/div/span[3]", selector.xpath("/html/body/div/span[3]")),
+        ("XPATH", "count(//span)", selector.xpath("count(//span)")),
+        ("XPATH", "//missing", selector.xpath("//missing")),
+        ("CSS", "div.note > p::text", selector.css("div.note > p::text")),
+        ("CSS", "span strong", selector.css("span strong")),
+    ]:
+        parser = ParselDocumentParser(url=None, path=path, path_type=path_type)
+        parser.request = httpx.Response(200, content=DocumentExamples.HTML.encode())
+        assert parser._get_path_data() == expected.get()
+        assert parser.error_code == 0
+
+
+def test_compiled_path_cache():
+    compiled_path_cache = CompiledPathCache(max_len=2)
+    hits = metrics.counters["compiled_path_cache_hits"]
+    for path in ["/a", "/b", "/a", "/c", "/b"]:
+        compiled_path_cache.get("JSON", path, compile_dpath)
+
+    assert metrics.counters["compiled_path_cache_hits"] == hits + 1
+    assert len(compiled_path_cache) == 2
+    assert compile_dpath("/note/items/0") == ("note", "items", 0)
+
+
+def test_sqlite_cache_backend(tmp_path):
+    """Verify that the SQLite backend shares items between instances, like workers on the same host would"""
+    path = str(tmp_path / "cache.sqlite3")
+    worker_cache = SQLiteCacheBackend(
+        path=path, max_len=2, max_bytes=2**20, max_age_seconds=60, compression="zlib"
+    )
+    other_worker_cache = SQLiteCacheBackend(
+        path=path, max_len=2, max_bytes=2**20, max_age_seconds=60, compression="zlib"
+    )
+    item = CacheItem.from_response(
+        httpx.Response(200, content=b"<html></html>", headers={"ETag": '"v1"'})
+    )
+    worker_cache.set("a", item)
+
+    shared_item = other_worker_cache.get("a")
+    assert shared_item.response.content == b"<html></html>"
+    assert shared_item.document_id == item.document_id
+    assert shared_item.created_datetime == item.created_datetime
+    assert shared_item.validator_headers == {"If-None-Match": '"v1"'}
+
+    shared_item.retrieved_count += 1
+    other_worker_cache.update("a", shared_item)
+    # Retrievals are counted in memory, and shared once they are flushed
+    assert other_worker_cache.get("a").retrieved_count == 1
+    assert worker_cache.get("a").retrieved_count == 0
+    other_worker_cache.flush()
+    assert worker_cache.get("a").retrieved_count == 1
+
+    # Setting an item again, as a revalidation does, writes its count without adding the pending retrievals twice
+    revalidated_item = other_worker_cache.get("a")
+    other_worker_cache.update("a", revalidated_item)
+    revalidated_item.retrieved_count += 1
+    other_worker_cache.set("a", revalidated_item)
+    other_worker_cache.flush()
+    assert worker_cache.get("a").retrieved_count == 2
+
+    # The retrieved item is kept over items that were never retrieved
+    worker_cache.set("b", item)
+    worker_cache.set("c", item)
+    assert worker_cache.get("a") is not None
+    assert len(other_worker_cache) == 2
+    assert worker_cache.stats()["evictions"] == 1
+
+
+def test_sqlite_cache_backend_expiry(tmp_path):
+    expired_cache = SQLiteCacheBackend(
+        path=str(tmp_path / "cache.sqlite3"),
+        max_len=2,
+        max_bytes=2**20,
+        max_age_seconds=0,
+    )
+    expired_cache.set("a", CacheItem(response=httpx.Response(200)))
+    assert expired_cache.get("a") is None
+
+
+def test_expired_items_are_revalidated(monkeypatch):
+    """Verify that an expired document is revalidated with its ETag and kept when it has not been modified"""
+
+    class RevalidatingClient:
+        request_headers = []
+
+        async def get(self, url, headers):
+            self.request_headers.append(headers)
+            if headers.get("If-None-Match") == '"v1"':
+                return httpx.Response(304)
+            return httpx.Response(
+                200, content=DocumentExamples.HTML.encode(), headers={"ETag": '"v1"'}
+            )
+
+    async def run_parser(revalidating_client):
+        parser = ParselDocumentParser(
+            "http://revalidate.test/page", "//span[3]/text()", "XPATH"
+        )
+        parser.request = await parser._get_response(revalidating_client)
+        await parser.select()
+        return parser
+
+    revalidating_client = RevalidatingClient()
+    loop = asyncio.get_event_loop()
+    first_parser = loop.run_until_complete(run_parser(revalidating_client))
+    monkeypatch.setattr(config.settings, "request_cache_max_age_seconds", 0)
+    # Revalidate before responding, rather than serving the expired document while it is refreshed
+    monkeypatch.setattr(config.settings, "request_cache_stale_seconds", 0)
+    parser = loop.run_until_complete(run_parser(revalidating_client))
+
+    assert revalidating_client.request_headers[1]["If-None-Match"] == '"v1"'
+    assert parser.revalidated
+    assert parser.cached_item is not None
+    assert parser.document_id == first_parser.document_id
+    assert parser.path_data == DocumentExamples.SUBJECT
+
+
+def test_memory_cache_backend_byte_budget():
+    """Verify that the memory backend stays within its byte budget, evicting rarely used items first"""
+    memory_cache = MemoryCacheBackend(
+        max_len=10, max_bytes=10000, max_age_seconds=60, compression="zlib"
+    )
+    for key in ["popular", "unpopular", "new"]:
+        memory_cache.set(
+            key, CacheItem(response=httpx.Response(200, content=os.urandom(3000)))
+        )
+        for _ in range(5):
+            memory_cache.get("popular")
+
+    assert memory_cache.stats()["bytes"] <= 10000
+    assert memory_cache.stats()["evictions"] == 1
+    assert memory_cache.get("unpopular") is None
+    assert memory_cache.get("popular") is not None
+
+
+def test_memory_cache_backend_compression():
+    memory_cache = MemoryCacheBackend(
+        max_len=10, max_bytes=2**20, max_age_seconds=60, compression="zlib"
+    )
+    item = CacheItem(
+        response=httpx.Response(200, content=DocumentExamples.HTML.encode() * 100)
+    )
+    memory_cache.set("a", item)
+
+    assert item.size_bytes < len(item.response.content)
+    assert memory_cache.get("a").response.content == item.response.content
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64 * 1024])
+def test_streaming_json_get(monkeypatch, chunk_size):
+    """Verify that streaming extraction returns the same data as loading the document does, whatever the chunk size"""
+    monkeypatch.setattr(streaming, "CHUNK_SIZE", chunk_size)
+    document = {
+        "skipped": {"nested": [1, {"a": '}]"['}], "text": 'quote " and \\ slash'},
+        "feed": {"entries": [{"title": "first"}, {"title": "second", "n": -1.5e3}]},
+        "empty": [],
+        "unicode": "caf\u00e9 \u2713",
+    }
+    content = json.dumps(document, indent=2).encode()
+    for path in [
+        "/feed/entries/1/title",
+        "/feed/entries/1",
+        "/skipped/text",
+        "/empty",
+        "/unicode",
+    ]:
+        segments = compile_dpath(path)
+        assert streaming.json_get(content, segments) == dpath.util.get(document, path)
+    for missing_path in ["/feed/missing", "/feed/entries/2", "/empty/0"]:
+        with pytest.raises(KeyError):
+            streaming.json_get(content, compile_dpath(missing_path))
+
+    content = "\ufeff" + json.dumps(document, ensure_ascii=False)
+    segments = compile_dpath("/unicode")
+    assert streaming.json_get(content.encode("utf-16-le"), segments, "utf-16-le") == (
+        document["unicode"]
+    )
+
+
+def test_streaming_xml_get():
+    content = (
+        b'<?xml version="1.0"?><feed xmlns:media="http://search.yahoo.com/mrss/">'
+        b"<title>Feed</title><entry id='1'><title>First</title></entry>"
+        b"<entry id='2'><title>Second</title><media:thumbnail url='a.png'/></entry></feed>"
+    )
+    document = xmltodict.parse(content)
+    for path in [
+        "/feed/title",
+        "/feed/entry/1/title",
+        "/feed/entry/1/@id",
+        "/feed/entry/1/media:thumbnail/@url",
+        "/feed/entry/0",
+    ]:
+        segments = compile_dpath(path)
+        assert streaming.xml_get(content, segments) == dpath.util.get(document, path)
+    with pytest.raises(KeyError):
+        streaming.xml_get(content, compile_dpath("/feed/entry/2"))
+
+
+def test_dpath_streaming():
+    use_local_upstream()
+    response = client.get(
+        "/dpath",
+        params={
+            "url": "http://localhost/examples/xml",
+            "path": "/note/subject",
+            "path_type": "XML",
+            "streaming": True,
+            "return_style": "VERBOSE",
+        },
+    )
+    assert response.json()["path_data"] == json.dumps(
+        DocumentExamples.SUBJECT, ensure_ascii=False
+    )
+
+
+def test_documents_over_the_size_limit_are_rejected(monkeypatch):
+    """Verify that downloads are aborted once they are larger than request_max_bytes"""
+    monkeypatch.setattr(config.settings, "request_max_bytes", 100)
+
+    async def body():
+        for _ in range(10):
+            yield b"x" * 50
+
+    def handler(request):
+        if request.url.path == "/declared":
+            return httpx.Response(200, content=b"x" * 500)
+        return httpx.Response(200, content=body())
+
+    async def fetch(path):
+        limited_upstream = UpstreamClient()
+        limited_upstream.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler)
+        )
+        with pytest.raises(DocumentTooLarge) as e:
+            await limited_upstream.get(f"http://large.test{path}")
+        await limited_upstream.close()
+        return e.value
+
+    loop = asyncio.get_event_loop()
+    declared_error = loop.run_until_complete(fetch("/declared"))
+    streamed_error = loop.run_until_complete(fetch("/streamed"))
+
+    assert declared_error.response.status_code == 200
+    assert "500 bytes" in str(declared_error)
+    assert "150 bytes" in str(streamed_error)
+
+
+def test_parser_reports_documents_over_the_size_limit(monkeypatch):
+    use_local_upstream()
+    monkeypatch.setattr(config.settings, "request_max_bytes", 10)
+    response = client.get(
+        "/parsel",
+        params={
+            "url": "http://localhost/examples/html?too_large",
+            "path": "//title/text()",
+            "return_style": "VERBOSE",
+        },
+    )
+    data = response.json()
+    assert data["parser_error"]["code"] == 5
+    assert data["path_data"] is None
+
+
+def test_dpath_lookup_matches_dpath():
+    """Verify that literal paths walked directly get the same data dpath gets"""
+    document = {
+        "note": {"items": [{"name": "a"}, {"name": "b"}], "0": "zero", "empty": None},
+        "text": "value",
+    }
+    for path in [
+        "/",
+        "/note/items/1/name",
+        "/note/0",
+        "/note/empty",
+        "/note/it*/0/name",
+    ]:
+        if path != "/note/it*/0/name":
+            assert DpathLookup(path).is_literal
+        assert DpathLookup(path)(document) == dpath.util.get(document, path)
+    for missing_path in ["/note/items/2", "/note/items/-1", "/text/0", "/note/missing"]:
+        with pytest.raises(KeyError):
+            DpathLookup(missing_path)(document)
+    # A glob matching several leaves is rejected with dpath's own message
+    with pytest.raises(ValueError, match="globs must match only one leaf : /note/\\*"):
+        DpathLookup("/note/*")(document)
+
+
+def test_xpath_lookup_matches_xmltodict():
+    """Verify that paths evaluated with lxml get the same data as xmltodict and dpath"""
+    content = (
+        b'<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom" '
+        b'xmlns:media="http://search.yahoo.com/mrss/"><title>Feed</title>'
+        b"<entry id='1'><title>First</title></entry>"
+        b"<entry id='2'><title>Second</title><media:thumbnail url='a.png'/></entry></feed>"
+    )
+    document = xmltodict.parse(content)
+    root = etree.fromstring(content)
+    for path in [
+        "/",
+        "/feed/title",
+        "/feed/entry",
+        "/feed/entry/1/title",
+        "/feed/entry/1/@id",
+        "/feed/entry/1/media:thumbnail/@url",
+        "/feed/entry/0",
+    ]:
+        assert XPathLookup(path)(root) == dpath.util.get(document, path)
+    with pytest.raises(KeyError):
+        XPathLookup("/feed/entry/2")(root)
+    with pytest.raises(ValueError):
+        XPathLookup("/feed/ent?y")
+
+
+def test_dpath_lxml_xml_mode():
+    use_local_upstream()
+    response = client.get(
+        "/dpath",
+        params={
+            "url": "http://localhost/examples/xml",
+            "path": "/note/subject",
+            "path_type": "XML",
+            "xml_mode": "lxml",
+            "return_style": "VERBOSE",
+        },
+    )
+    assert response.json()["path_data"] == json.dumps(
+        DocumentExamples.SUBJECT, ensure_ascii=False
+    )
+
+
+def test_basic_response_and_pretty_data():
+    """Verify that the BASIC return style only has the basic keys, and that path data is only indented with pretty"""
+    use_local_upstream()
+    params = {"url": "http://localhost/examples/json", "path": "/note"}
+    compact = client.get("/dpath", params=params).json()
+    pretty = client.get("/dpath", params={**params, "pretty": True}).json()
+
+    assert sorted(compact) == ["path_data", "request_error", "used_cache"]
+    assert json.loads(compact["path_data"]) == json.loads(pretty["path_data"])
+    assert "\n" not in compact["path_data"]
+    assert "\n  " in pretty["path_data"]
+
+
+def test_metrics_endpoint():
+    """Verify that stage timings, counters and gauges are exported in the Prometheus format"""
+    use_local_upstream()
+    client.get(
+        "/parsel",
+        params={"url": "http://localhost/examples/html?metrics", "path": "//title"},
+    )
+    response = client.get("/metrics")
+    lines = response.text.splitlines()
+
+    assert response.headers["content-type"].startswith("text/plain")
+    for stage in ["cache_lookup", "upstream_fetch", "fetch", "parse", "select"]:
+        assert f'stage_duration_seconds_count{{stage="{stage}"}}' in response.text
+    assert (
+        'http_request_duration_seconds_count{handler="parse_data_with_parsel_selectors"}'
+        in response.text
+    )
+    assert "# TYPE request_cache_misses_total counter" in lines
+    assert "http_requests_in_flight 1" in lines  # The request for /metrics itself
+    assert "upstream_requests_in_flight 0" in lines
+
+
+def test_counters_are_incremented_from_many_threads():
+    """Verify that no increment is lost when counters are incremented from the parse threads concurrently"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def increment_many(_):
+        for _ in range(10000):
+            metrics.increment("test_concurrent_increments")
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(increment_many, range(8)))
+    assert metrics.counters.pop("test_concurrent_increments") == 80000
+
+
+def test_profile():
+    """Verify that a profiled request returns its timings, document size and node count, in the body and header"""
+    use_local_upstream()
+    response = client.get(
+        "/parsel",
+        params={
+            "url": "http://localhost/examples/html?profile",
+            "path": "//title/text()",
+            "profile": True,
+        },
+    )
+    profile = response.json()["profile"]
+
+    assert {"fetch", "upstream_fetch", "parse", "select"} <= set(profile["timings_ms"])
+    assert profile["document_bytes"] == len(client.get("/examples/html").content)
+    assert profile["node_count"] > 1
+    server_timing = response.headers["Server-Timing"]
+    assert "parse;dur=" in server_timing
+    assert "serialize;dur=" in server_timing
+    assert f'document_bytes;desc="{profile["document_bytes"]}"' in server_timing
+
+
+def test_raw_data_is_decoded_once_with_the_declared_charset():
+    """Verify that documents are decoded with their declared charset, and that cached items keep the decoded text"""
+    document = (
+        "<html><head><meta charset='windows-1252'></head><body>Café</body></html>"
+    )
+    item = CacheItem.from_response(
+        httpx.Response(200, content=document.encode("windows-1252"))
+    )
+    memory_cache = MemoryCacheBackend(max_len=10, max_bytes=2**20, max_age_seconds=60)
+    memory_cache.set("page", item)
+
+    parser = ParselDocumentParser("http://charset.test/", "//body/text()", "XPATH")
+    parser.request = parser._use_cached_item(memory_cache.get("page"))
+    assert parser.raw_data == document
+    assert "decode" in parser.timings
+
+    parser = ParselDocumentParser("http://charset.test/", "//body/text()", "XPATH")
+    parser.request = parser._use_cached_item(memory_cache.get("page"))
+    assert parser.raw_data == document
+    assert "decode" not in parser.timings
+
+    utf8_item = CacheItem.from_response(
+        httpx.Response(
+            200,
+            content="\ufeff{}".encode("utf-8"),
+            headers={"Content-Type": "application/json; charset=utf-8"},
+        )
+    )
+    assert utf8_item.decode() == "{}"
+
+
+def test_parsel_getall_with_offset_and_limit():
+    use_local_upstream()
+    params = {"url": "http://localhost/examples/html", "path": "//span/text()"}
+    first = client.get("/parsel", params=params).json()["path_data"]
+    matches = json.loads(
+        client.get("/parsel", params={**params, "getall": True}).json()["path_data"]
+    )
+    page = json.loads(
+        client.get(
+            "/parsel", params={**params, "getall": True, "offset": 1, "limit": 1}
+        ).json()["path_data"]
+    )
+
+    assert len(matches) > 2
+    assert matches[0].strip() == first
+    assert page == matches[1:2]
+
+
+def test_parsel_stream():
+    use_local_upstream()
+    params = {"url": "http://localhost/examples/html", "path": "//span/text()"}
+    response = client.get("/parsel/stream", params=params)
+    lines = [json.loads(line) for line in response.content.splitlines()]
+    matches = json.loads(
+        client.get("/parsel", params={**params, "getall": True}).json()["path_data"]
+    )
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [line["match"] for line in lines] == matches
+
+    response = client.get("/parsel/stream", params={**params, "path": "//span["})
+    assert json.loads(response.text.splitlines()[-1])["parser_error"]["code"] == 2
+
+
+def test_verbose_raw_data_modes():
+    use_local_upstream()
+    params = {
+        "url": "http://localhost/examples/html",
+        "path": "//span[3]/text()",
+        "return_style": "VERBOSE",
+    }
+    document = client.get("/examples/html").text
+
+    def get(**mode_params):
+        return client.get("/parsel", params={**params, **mode_params}).json()
+
+    assert get()["raw_data"] == document
+    assert get(raw_data_mode="NONE")["raw_data"] is None
+    assert (
+        get(raw_data_mode="TRUNCATE", raw_data_length=20)["raw_data"] == document[:20]
+    )
+    assert (
+        get(raw_data_mode="RANGE", raw_data_start=5, raw_data_end=30)["raw_data"]
+        == document.encode()[5:30].decode()
+    )
+
+    # The encoding is found for documents that are not decoded to be searched
+    parser = DpathDocumentParser("http://range.test/", "/note/to", "XML")
+    xml_document = (
+        '<?xml version="1.0" encoding="ISO-8859-1"?><note><to>Zoë</to></note>'
+    )
+    parser.request = httpx.Response(200, content=xml_document.encode("latin-1"))
+    parser.item = CacheItem(response=parser.request)
+    parser.xml_mode = "lxml"
+    parser.raw_data_mode = "RANGE"
+    parser.raw_data_start = xml_document.index("<to>")
+    parser.raw_data_end = xml_document.index("</note>")
+    asyncio.get_event_loop().run_until_complete(parser.select())
+    assert parser.raw_path_data == "Zoë"
+    assert parser.raw_data_selection() == ("<to>Zoë</to>", None)
+
+    match = get(raw_data_mode="MATCH")
+    assert match["raw_data"].startswith("<span>")
+    assert DocumentExamples.SUBJECT in match["raw_data"]
+    assert match["raw_data"] in document.splitlines()[match["raw_data_sourceline"] - 1]
+
+
+def test_node_index_matches_css_selectors(monkeypatch):
+    """Verify that simple CSS selectors answered from the node index return what searching the tree returns"""
+    document = (
+        "<html><body><div id='main' class='box wide'>Main <a href='/a' class='link'>A</a> tail"
+        "<div class='box'>Inner <span class='link'>S</span></div></div>"
+        "<p class='link'>P <b>bold</b> after</p><!-- comment -->"
+        "<i class='a\xa0b' xml:lang='fr'>nbsp</i><i class='c\u2003d'>em space</i>"
+        "<i class='e\x0cf'>form feed</i></body></html>"
+    )
+    selectors = [
+        "#main",
+        "#main::text",
+        ".box",
+        ".box::text",
+        ".link::text",
+        ".link::attr(href)",
+        "DIV",
+        "p::text",
+        "#missing",
+        "div > span",
+        ".b",
+        ".d::text",
+        ".e",
+        ".f::text",
+        "i::attr(xml:lang)",
+    ]
+
+    def results(path, document_id):
+        parser = ParselDocumentParser("http://index.test/", path, "CSS")
+        parser.request = httpx.Response(200, content=document.encode())
+        parser.document_id = document_id
+        parser.getall = True
+        return parser._get_path_data()
+
+    hits = metrics.counters["node_index_hits"]
+    for path in selectors:
+        assert results(path, "indexed") == results(path, None), path
+    # Nested .box elements, the complex selector and the namespaced attribute were searched for in the tree
+    assert metrics.counters["node_index_hits"] == hits + len(selectors) - 3
+
+
+def test_heavy_libraries_are_imported_when_first_needed():
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, app.main; print(' '.join(name for name in "
+            "['sentry_sdk', 'parsel', 'lxml', 'xmltodict', 'dpath', 'w3lib'] if name in sys.modules))",
+        ],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    assert imported == []
+
+
+def test_openapi_has_the_data_response_examples():
+    paths = client.get("/openapi.json").json()["paths"]
+    for path in ["/dpath", "/parsel"]:
+        examples = paths[path]["get"]["responses"]["200"]["content"][
+            "application/json"
+        ]["examples"]
+        assert list(examples) == ["BASIC", "DATA_ONLY", "VERBOSE"]
+
+
+class VersionedClient:
+    """An upstream client whose document changes with every request, without validators."""
+
+    def __init__(self):
+        self.requests = 0
+
+    async def get(self, url, headers):
+        self.requests += 1
+        return httpx.Response(
+            200, content=f"<html><p>v{self.requests}</p></html>".encode()
+        )
+
+
+def run_versioned_parser(versioned_client, url):
+    async def run_parser():
+        parser = ParselDocumentParser(url, "//p/text()", "XPATH")
+        parser.request = await parser._get_response(versioned_client)
+        await parser.select()
+        return parser
+
+    return asyncio.get_event_loop().run_until_complete(run_parser())
+
+
+def wait_for_background_refreshes():
+    asyncio.get_event_loop().run_until_complete(
+        asyncio.gather(*list(in_flight.values()))
+    )
+
+
+def test_stale_items_are_served_while_refreshed(monkeypatch):
+    versioned_client = VersionedClient()
+    url = "http://stale.test/page"
+    assert run_versioned_parser(versioned_client, url).path_data == "v1"
+
+    monkeypatch.setattr(config.settings, "request_cache_max_age_seconds", 0)
+    stale_parser = run_versioned_parser(versioned_client, url)
+    assert stale_parser.stale
+    assert stale_parser.path_data == "v1"
+    request_item = ParselRequest(url=url, path="//p/text()", return_style="VERBOSE")
+    content = BaseResponse.content_from_parser(request_item, stale_parser)
+    assert content["cache_info"]["stale"] is True
+
+    wait_for_background_refreshes()
+    assert versioned_client.requests == 2
+    monkeypatch.setattr(config.settings, "request_cache_max_age_seconds", 60)
+    parser = run_versioned_parser(versioned_client, url)
+    assert not parser.stale
+    assert parser.path_data == "v2"
+
+    # Past the stale window the caller waits for the document
+    monkeypatch.setattr(config.settings, "request_cache_max_age_seconds", 0)
+    monkeypatch.setattr(config.settings, "request_cache_stale_seconds", 0)
+    parser = run_versioned_parser(versioned_client, url)
+    assert not parser.stale
+    assert parser.path_data == "v3"
+
+
+def test_popular_items_are_refreshed_before_they_expire(monkeypatch):
+    monkeypatch.setattr(config.settings, "request_cache_refresh_min_retrievals", 2)
+    monkeypatch.setattr(config.settings, "request_cache_refresh_ahead_seconds", 120)
+    versioned_client = VersionedClient()
+    url = "http://popular.test/page"
+    refreshes = metrics.counters["background_refreshes"]
+
+    paths_data = [
+        run_versioned_parser(versioned_client, url).path_data for _ in range(3)
+    ]
+    assert paths_data == ["v1", "v1", "v1"]
+
+    # The third request was the second retrieval of the cached item, which started a refresh
+    wait_for_background_refreshes()
+    assert versioned_client.requests == 2
+    assert metrics.counters["background_refreshes"] == refreshes + 1
+    parser = run_versioned_parser(versioned_client, url)
+    assert parser.path_data == "v2"
+    assert parser.cached_item.retrieved_count == 1
+
+
+def test_sqlite_cache_backend_serves_parsers(monkeypatch, tmp_path):
+    """Verify that parsers read and write the SQLite backend from the event loop, without writing on every hit"""
+    sqlite_cache = SQLiteCacheBackend(
+        path=str(tmp_path / "cache.sqlite3"),
+        max_len=10,
+        max_bytes=2**20,
+        max_age_seconds=60,
+    )
+    monkeypatch.setattr(util, "cache", sqlite_cache)
+    versioned_client = VersionedClient()
+    url = "http://sqlite.test/page"
+
+    parsers = [run_versioned_parser(versioned_client, url) for _ in range(3)]
+    assert [parser.path_data for parser in parsers] == ["v1", "v1", "v1"]
+    assert versioned_client.requests == 1
+    assert parsers[-1].cached_item.retrieved_count == 2
+    assert sqlite_cache._pending_hits[f"{url}-{parsers[-1].user_agent}"] == 2
+
+
+def test_missing_h2_package_is_logged(monkeypatch, caplog):
+    monkeypatch.setattr(config.settings, "upstream_http2", True)
+    monkeypatch.setitem(sys.modules, "h2", None)  # Makes importing h2 raise ImportError
+    assert not UpstreamClient._http2_enabled()
+    assert "`h2` package is not installed" in caplog.text
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_full_cache_admits_new_documents(backend, tmp_path):
+    """Verify that a new document is cached even when every cached item has been retrieved"""
+    if backend == "sqlite":
+        full_cache = SQLiteCacheBackend(
+            path=str(tmp_path / "cache.sqlite3"),
+            max_len=3,
+            max_bytes=2**20,
+            max_age_seconds=60,
+        )
+    else:
+        full_cache = MemoryCacheBackend(max_len=3, max_bytes=2**20, max_age_seconds=60)
+    for key in "abc":
+        full_cache.set(
+            key, CacheItem(response=httpx.Response(200, content=b"x" * 1000))
+        )
+        item = full_cache.get(key)
+        item.retrieved_count += 1
+        full_cache.update(key, item)
+    full_cache.flush()
+
+    for key in "defgh":
+        full_cache.set(
+            key, CacheItem(response=httpx.Response(200, content=b"x" * 1000))
+        )
+        assert full_cache.get(key) is not None, key
+    assert len(full_cache) == 3
@@ -1,13 +1,22 @@
 import json
 import asyncio
+import logging
+import threading
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, Counter
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
 import httpx
+import orjson
 from httpx import Response
-from expiringdict import ExpiringDict
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from . import config
+from . import config, metrics
+from .cache import create_backend, build_response
+
+logger = logging.getLogger(__name__)
 
 XPATH = "XPATH"
 CSS = "CSS"
@@ -15,10 +24,42 @@ REGEX = "REGEX"
 JSON = "JSON"
 XML = "XML"
 
-cache = ExpiringDict(
-    max_len=config.settings.request_cache_max_len,
-    max_age_seconds=config.settings.request_cache_max_age_seconds,
-)
+# How much of the document is returned as the raw_data of a VERBOSE response
+RAW_DATA_FULL = "FULL"
+RAW_DATA_NONE = "NONE"
+RAW_DATA_TRUNCATE = "TRUNCATE"
+RAW_DATA_RANGE = "RANGE"
+RAW_DATA_MATCH = "MATCH"
+
+cache = create_backend(config.settings)
+
+
+def json_default(value):
+    """Encodes the values orjson does not support, the same way pydantic encodes them."""
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, BaseModel):
+        return value.dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def json_dumps(content, pretty=False):
+    """Encodes the content as JSON bytes with orjson, indented by 2 spaces when pretty is set."""
+    try:
+        return orjson.dumps(
+            content,
+            default=json_default,
+            option=orjson.OPT_INDENT_2 if pretty else 0,
+        )
+    except orjson.JSONEncodeError:
+        # orjson can not encode integers over 64 bits, which json documents may contain
+        return json.dumps(
+            content, default=json_default, indent=2 if pretty else None
+        ).encode("utf-8")
+
+
+# Upstream requests that are currently being made, keyed by their cache_key
+in_flight = {}
 
 
 http_response_codes = {
@@ -120,13 +161,86 @@ def get_data_response_examples(verbose_example):
     return data_responses
 
 
+def add_data_response_examples(routes, verbose_examples):
+    """Adds the example responses for the docs to the routes with a verbose example for their path.
+
+    Called when the OpenAPI schema is first generated, rather than when the routes are declared.
+    """
+    for route in routes:
+        if route.path in verbose_examples:
+            route.responses.update(
+                get_data_response_examples(verbose_examples[route.path])
+            )
+
+
 class CacheItem(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
     response: Response
-    created_datetime: datetime = datetime.now()
+    created_datetime: datetime = Field(default_factory=datetime.now)
     retrieved_count: int = 0
+    document_id: str = Field(default_factory=lambda: uuid4().hex)
+    etag: str = None
+    last_modified: str = None
+    size_bytes: int = None  # Set by the cache backend when the item is cached
+    text: str = None  # The decoded document, set by decode()
+    encoding: str = None  # The encoding the document was decoded with, set by decode()
+
+    @classmethod
+    def from_response(cls, response):
+        """Creates an item for the response, storing the validators needed to revalidate it once it expires"""
+        return cls(
+            response=response,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+    def decode(self):
+        """Returns the document as text, decoding it the first time it is needed.
+
+        The encoding is the charset of the Content-Type header, else the one of the BOM, else the one declared in
+        the document by a meta tag or XML declaration, else one auto-detected from the content, falling back to UTF-8.
+        """
+        if self.text is None:
+            from w3lib.encoding import html_to_unicode
+
+            self.encoding, self.text = html_to_unicode(
+                self.response.headers.get("Content-Type"), self.response.content
+            )
+        return self.text
+
+    def detect_encoding(self):
+        """Returns the encoding decode() decodes the document with, finding it without decoding the document.
+
+        It is taken from the Content-Type charset, then the BOM, then the encoding declared in the document, in the
+        same order as decode(), and is UTF-8 when none of them give one.
+        """
+        if self.encoding is None:
+            from w3lib.encoding import (
+                http_content_type_encoding,
+                read_bom,
+                html_body_declared_encoding,
+            )
+
+            content = self.response.content
+            encoding = http_content_type_encoding(
+                self.response.headers.get("Content-Type")
+            )
+            bom_encoding, _ = read_bom(content)
+            if encoding in ("utf-16", "utf-32"):
+                # The BOM gives the byte order, big endian when there is none
+                if bom_encoding is not None and bom_encoding.startswith(encoding):
+                    encoding = bom_encoding
+                else:
+                    encoding += "-be"
+            self.encoding = (
+                encoding
+                or bom_encoding
+                or html_body_declared_encoding(content)
+                or "utf-8"
+            )
+        return self.encoding
 
     @property
     def age(self):
@@ -138,6 +252,345 @@ class CacheItem(BaseModel):
             timedelta(seconds=config.settings.request_cache_max_age_seconds) - self.age
         )
 
+    @property
+    def is_fresh(self):
+        """Returns if the item can be used without revalidating it with the upstream server"""
+        return self.time_remaining > timedelta(0)
+
+    @property
+    def is_servable_stale(self):
+        """Returns if the item has expired recently enough to be served while it is refreshed in the background"""
+        return not self.is_fresh and -self.time_remaining < timedelta(
+            seconds=config.settings.request_cache_stale_seconds
+        )
+
+    @property
+    def needs_refresh(self):
+        """Returns if the item is retrieved often enough to be refreshed in the background before it expires"""
+        min_retrievals = config.settings.request_cache_refresh_min_retrievals
+        return (
+            0 < min_retrievals <= self.retrieved_count
+            and self.time_remaining
+            < timedelta(seconds=config.settings.request_cache_refresh_ahead_seconds)
+        )
+
+    @property
+    def validator_headers(self):
+        """Returns the headers that ask the upstream server to only send the document if it has changed"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class DocumentCache:
+    """An LRU cache of parsed documents, so that repeated queries against a cached response skip parsing it again.
+
+    Entries are keyed by a cache_key and a parse mode, and are only returned while the document_id of the
+    cached response they were parsed from is unchanged.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # Documents may be parsed in a thread pool
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, document_id):
+        """Returns the parsed document for the key, None when it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != document_id:
+                metrics.increment("document_cache_misses")
+                return None
+            self._entries.move_to_end(key)
+            metrics.increment("document_cache_hits")
+            return entry[1]
+
+    def set(self, key, document_id, document, size):
+        """Caches a parsed document, evicting the least recently used documents to stay within max_bytes."""
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (document_id, document, size)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                metrics.increment("document_cache_evictions")
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[2]
+        return entry
+
+
+document_cache = DocumentCache(max_bytes=config.settings.document_cache_max_bytes)
+
+
+class CompiledPathCache:
+    """An LRU cache of compiled paths keyed by (path_type, path), so that frequently used paths are compiled once."""
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # Paths may be compiled in a thread pool
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path_type, path, compile_path):
+        """Returns the compiled path, compiling it with compile_path(path) when it is not cached.
+
+        Errors raised by compile_path are passed on to the caller and nothing is cached.
+        """
+        key = (path_type, path)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.increment("compiled_path_cache_hits")
+                return self._entries[key]
+
+        compiled = compile_path(path)
+        with self._lock:
+            metrics.increment("compiled_path_cache_misses")
+            self._entries[key] = compiled
+            while len(self._entries) > self.max_len:
+                self._entries.popitem(last=False)
+        return compiled
+
+
+compiled_paths = CompiledPathCache(max_len=config.settings.compiled_path_cache_max_len)
+
+
+class DocumentTooLarge(Exception):
+    """Raised when an upstream document is larger than the request_max_bytes config variable allows."""
+
+    def __init__(self, response, size):
+        self.response = response
+        super().__init__(
+            f"The document is larger than the {config.settings.request_max_bytes} bytes this API will download, "
+            f"{size} bytes or more were sent"
+        )
+
+
+class UpstreamClient:
+    """An app wide httpx client shared between requests so that upstream connections are kept alive and reused."""
+
+    def __init__(self):
+        self.client = None
+        self._host_semaphores = {}
+        self._host_users = (
+            Counter()
+        )  # Requests holding or waiting on each host's semaphore
+
+    @staticmethod
+    def _http2_enabled():
+        """HTTP/2 is only used when requested in the config and the optional `h2` package is installed."""
+        if not config.settings.upstream_http2:
+            return False
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning(
+                "HTTP/2 was requested for upstream requests but the `h2` package is not installed"
+            )
+            return False
+        return True
+
+    async def start(self):
+        """Opens the shared client, called when the app starts up."""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=self._http2_enabled(),
+                limits=httpx.Limits(
+                    max_connections=config.settings.upstream_max_connections,
+                    max_keepalive_connections=config.settings.upstream_max_keepalive_connections,
+                    keepalive_expiry=config.settings.upstream_keepalive_expiry_seconds,
+                ),
+            )
+
+    async def close(self):
+        """Closes the shared client and all of its connections, called when the app shuts down."""
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+        self._host_semaphores = {}
+        self._host_users = Counter()
+
+    @staticmethod
+    def _host(url):
+        return urlsplit(url).netloc.lower()
+
+    def host_limit(self, url):
+        """Returns the semaphore limiting concurrent requests to the host of the url, None when there is no limit."""
+        if config.settings.upstream_max_connections_per_host <= 0:
+            return None
+        host = self._host(url)
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(
+                config.settings.upstream_max_connections_per_host
+            )
+        return self._host_semaphores[host]
+
+    async def get(self, url, **kwargs):
+        """Makes a GET request with the shared client, honoring the per host connection limit."""
+        if self.client is None:
+            await self.start()
+        host_limit = self.host_limit(url)
+        if host_limit is None:
+            return await self._get(url, **kwargs)
+        host = self._host(url)
+        self._host_users[host] += 1
+        try:
+            async with host_limit:
+                return await self._get(url, **kwargs)
+        finally:
+            # Forget the host once no request holds or waits on its semaphore, so the map does not grow with every
+            # host that is ever requested
+            self._host_users[host] -= 1
+            if self._host_users[host] <= 0:
+                del self._host_users[host]
+                self._host_semaphores.pop(host, None)
+
+    async def _get(self, url, **kwargs):
+        """Streams the response body, raising DocumentTooLarge as soon as it is more than request_max_bytes"""
+        max_bytes = config.settings.request_max_bytes
+        async with self.client.stream("GET", url, **kwargs) as response:
+            content_length = response.headers.get("Content-Length", "")
+            if (
+                max_bytes
+                and content_length.isdigit()
+                and int(content_length) > max_bytes
+            ):
+                raise DocumentTooLarge(build_response(response, b""), content_length)
+
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise DocumentTooLarge(build_response(response, b""), size)
+                chunks.append(chunk)
+        return build_response(response, b"".join(chunks))
+
+
+upstream = UpstreamClient()
+
+
+def count_nodes(document):
+    """Counts the elements in an lxml tree or parsel Selector, or the values in a document of dicts and lists."""
+    root = getattr(document, "root", document)  # Selectors wrap an lxml tree
+    if hasattr(root, "iter"):
+        return sum(1 for _ in root.iter())
+
+    count = 0
+    values = [document]
+    while values:
+        value = values.pop()
+        count += 1
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, list):
+            values.extend(value)
+    return count
+
+
+def _get_path_data_in_process(parser):
+    """Runs a copy of a parser in a worker process, returning the data and any parser error."""
+    parser.timings = {}
+    data = parser._get_path_data()
+    return data, parser.error_code, parser.error_msg, parser.timings
+
+
+class ParseExecutor:
+    """A pool of threads or processes that large documents are parsed in, so parsing does not block the event loop.
+
+    Parsers in a process pool work on a copy of the document, so they do not use the parsed document cache.
+    """
+
+    def __init__(self):
+        self.executor = None
+
+    def start(self):
+        """Creates the pool based on the config, called when the app starts up."""
+        if self.executor is not None:
+            return
+        if config.settings.parse_executor == "thread":
+            self.executor = ThreadPoolExecutor(
+                max_workers=config.settings.parse_executor_workers,
+                thread_name_prefix="parse",
+            )
+        elif config.settings.parse_executor == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=config.settings.parse_executor_workers
+            )
+
+    def close(self):
+        """Shuts the pool down, called when the app shuts down."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = None
+
+    async def get_path_data(self, parser):
+        """Runs the parsers _get_path_data(), in the pool when the document is large enough to be worth it."""
+        if self.executor is None:
+            self.start()
+        if (
+            self.executor is None
+            or len(parser.request.content) < config.settings.parse_inline_max_bytes
+        ):
+            return parser._get_path_data()
+
+        loop = asyncio.get_event_loop()
+        if isinstance(self.executor, ProcessPoolExecutor):
+            (
+                data,
+                parser.error_code,
+                parser.error_msg,
+                timings,
+            ) = await loop.run_in_executor(
+                self.executor,
+                _get_path_data_in_process,
+                parser,
+            )
+            for stage, seconds in timings.items():
+                parser.timings[stage] = parser.timings.get(stage, 0.0) + seconds
+            return data
+        return await loop.run_in_executor(self.executor, parser._get_path_data)
+
+
+parse_executor = ParseExecutor()
+
+
+async def run_bulk(parsers, concurrency):
+    """Runs the parsers with at most `concurrency` running at a time, yielding each parser as soon as it is done."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_parser(parser):
+        async with semaphore:
+            try:
+                await parser.run()
+            except httpx.HTTPError as e:
+                parser.error_code = 4
+                parser.error_msg = f"There was an error requesting the document: {e}"
+        return parser
+
+    tasks = [asyncio.ensure_future(run_parser(parser)) for parser in parsers]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Stop any remaining work when the client goes away before every url is done
+        for task in tasks:
+            task.cancel()
+
 
 class BaseDocumentParser:
     """Do the work of parsing data from an online document using various parsing library's."""
@@ -156,7 +609,16 @@ class BaseDocumentParser:
     error_code = 0
     error_msg = "Success"
     content_reformatted = False
+    raw_data_mode = RAW_DATA_FULL
+    raw_data_length = 1000  # Characters kept by RAW_DATA_TRUNCATE
+    raw_data_start = 0  # Byte range returned by RAW_DATA_RANGE
+    raw_data_end = None
     cached_item = None
+    item = None  # The CacheItem of the response, which keeps its decoded text
+    coalesced = False
+    revalidated = False
+    stale = False  # The cached item was served after it expired, while it is refreshed in the background
+    document_id = None
 
     def __init__(
         self,
@@ -164,42 +626,180 @@ class BaseDocumentParser:
         path,
         path_type,
         user_agent=default_user_agent,
+        pretty=False,
     ):
         self.__url = url
         self.path = path
         self.path_type = path_type
         self.user_agent = user_agent
+        self.pretty = pretty  # Indent the data reformatted as JSON
+        self.timings = {}  # Seconds spent in each stage of this request
+        self._documents = (
+            {}
+        )  # Documents parsed by this parser, shared with parsers made by for_path()
 
     async def run(self):
         """Makes the get request for the requested data"""
-        async with httpx.AsyncClient() as client:
-            make_request = self._get_response(client)
-            response = await asyncio.gather(make_request)
-            self.request = response[0]
-
-            # Extract the data using the path provided
-            self.path_data = self.raw_path_data = self._get_path_data()
-
-            # Reformat data when the data should be represented as JSON
-            if self.path_type in [self.JSON, self.XML, self.REGEX]:
-                self.content_reformatted = True
-                self.path_data = json.dumps(self.path_data, indent=2)
+        with metrics.timer("fetch", self.timings):
+            await self.fetch()
+        with metrics.timer("select", self.timings):
+            await self.select()
+
+    async def run_paths(self, paths):
+        """Fetches the document once and extracts the data at each of the paths, returning a parser for each path name"""
+        with metrics.timer("fetch", self.timings):
+            await self.fetch()
+        path_parsers = {}
+        for path_item in paths:
+            path_parser = self.for_path(path_item.path, path_item.path_type)
+            with metrics.timer("select", path_parser.timings):
+                await path_parser.select()
+            path_parsers[path_item.name] = path_parser
+        return path_parsers
+
+    async def fetch(self):
+        """Gets the document, from the cache when possible"""
+        try:
+            self.request = await self._get_response(upstream)
+        except DocumentTooLarge as e:
+            self.request = e.response
+            self.error_code = 5
+            self.error_msg = str(e)
+
+    async def select(self):
+        """Extracts the data at the path from the fetched document"""
+        if self.error_code:
+            return  # There is no document to select from when fetching it failed
+
+        # Extract the data using the path provided
+        self.path_data = self.raw_path_data = await parse_executor.get_path_data(self)
+
+        # Reformat data when the data should be represented as JSON
+        if self.path_type in [self.JSON, self.XML, self.REGEX] or isinstance(
+            self.path_data, list
+        ):
+            self.content_reformatted = True
+            self.path_data = json_dumps(self.path_data, self.pretty).decode("utf-8")
 
     async def _get_response(self, client):
-        if self.cache_key in cache.keys():
-            self.cached_item = cache[self.cache_key]
-            self.cached_item.retrieved_count += 1
-            return self.cached_item.response
-
-        response = await client.get(
-            self.url,
-            headers={"User-Agent": self.user_agent},
+        with metrics.timer("cache_lookup", self.timings):
+            cached_item = await cache.get_async(self.cache_key)
+        if cached_item is not None and cached_item.is_fresh:
+            metrics.increment("request_cache_hits")
+            response = self._use_cached_item(cached_item)
+            if cached_item.needs_refresh:
+                self._refresh_in_background(client, cached_item)
+            return response
+        if cached_item is not None and cached_item.is_servable_stale:
+            metrics.increment("request_cache_stale_hits")
+            self.stale = True
+            self._refresh_in_background(client, cached_item)
+            return self._use_cached_item(cached_item)
+        metrics.increment("request_cache_misses")
+
+        # An expired item is kept so it can be revalidated, when the upstream server gave us validators for it
+        stale_item = (
+            cached_item
+            if cached_item is not None and cached_item.validator_headers
+            else None
+        )
+
+        # Wait for an identical request that is already being made instead of making another one
+        cache_key = self.cache_key
+        if cache_key in in_flight:
+            self.coalesced = True
+            metrics.increment("coalesced_requests")
+            fetched_item = await asyncio.shield(in_flight[cache_key])
+        else:
+            fetched_item = await self._start_fetch(client, stale_item)
+
+        if (
+            stale_item is not None
+            and fetched_item.document_id == stale_item.document_id
+        ):
+            self.revalidated = True
+            return self._use_cached_item(fetched_item)
+
+        self.item = fetched_item
+        if fetched_item.response.status_code == 200:
+            self.document_id = fetched_item.document_id
+        return fetched_item.response
+
+    def _use_cached_item(self, cached_item):
+        """Uses the document in a cached item as the response to this request"""
+        self.cached_item = self.item = cached_item
+        self.cached_item.retrieved_count += 1
+        cache.update(self.cache_key, self.cached_item)
+        self.document_id = self.cached_item.document_id
+        return self.cached_item.response
+
+    async def _start_fetch(self, client, stale_item=None):
+        """Makes the upstream request, registering it so that identical requests can wait on it"""
+        fetch = self._register_fetch(client, stale_item)
+        # Shielded so that a cancelled caller does not cancel the request for everyone waiting on it
+        return await asyncio.shield(fetch)
+
+    def _register_fetch(self, client, stale_item=None):
+        """Starts the upstream request as a task, registered in in_flight until it is done"""
+        cache_key = self.cache_key
+
+        fetch = asyncio.ensure_future(self._fetch_response(client, stale_item))
+        in_flight[cache_key] = fetch
+
+        def remove_in_flight(_):
+            if in_flight.get(cache_key) is fetch:
+                del in_flight[cache_key]
+
+        fetch.add_done_callback(remove_in_flight)
+        return fetch
+
+    def _refresh_in_background(self, client, cached_item):
+        """Refreshes the cached item without waiting for it, unless an identical request is already being made.
+
+        The request is conditional when the item has validators, and the item stays cached when the refresh fails.
+        """
+        if self.cache_key in in_flight:
+            return
+        metrics.increment("background_refreshes")
+        fetch = self._register_fetch(
+            client, cached_item if cached_item.validator_headers else None
         )
 
+        def count_errors(_):
+            if not fetch.cancelled() and fetch.exception() is not None:
+                metrics.increment("background_refresh_errors")
+
+        fetch.add_done_callback(count_errors)
+
+    async def _fetch_response(self, client, stale_item=None):
+        """Makes the upstream request and caches the response when it was successful
+
+        When a stale item is passed the request is conditional, and the stale item is refreshed and returned
+        if the upstream server responds that the document has not been modified.
+        """
+        metrics.increment("upstream_requests")
+        headers = {"User-Agent": self.user_agent}
+        if stale_item is not None:
+            headers.update(stale_item.validator_headers)
+        with metrics.timer("upstream_fetch", self.timings), metrics.in_flight(
+            "upstream_requests_in_flight"
+        ):
+            response = await client.get(
+                self.url,
+                headers=headers,
+            )
+
+        if stale_item is not None and response.status_code == 304:
+            metrics.increment("revalidated_requests")
+            stale_item.created_datetime = datetime.now()
+            await cache.set_async(self.cache_key, stale_item)
+            return stale_item
+
+        fetched_item = CacheItem.from_response(response)
         if response.status_code == 200:
-            cache[self.cache_key] = CacheItem(response=response)
-            
-        return response
+            await cache.set_async(self.cache_key, fetched_item)
+
+        return fetched_item
 
     @property
     def url(self):
@@ -219,28 +819,153 @@ class BaseDocumentParser:
 
     @property
     def raw_data(self):
-        """Returns the raw data that we got back from the request"""
-        return self.request.content.decode("utf-8")
+        """Returns the raw data that we got back from the request, decoded once per cached document"""
+        if self.item is None:
+            self.item = CacheItem.from_response(self.request)
+        if self.item.text is None:
+            with metrics.timer("decode", self.timings):
+                self.item.decode()
+        return self.item.text
+
+    @property
+    def encoding(self):
+        """Returns the encoding the raw data is decoded with, without decoding it"""
+        if self.item is None:
+            self.item = CacheItem.from_response(self.request)
+        return self.item.detect_encoding()
+
+    def raw_data_selection(self):
+        """Returns the part of the raw data selected by the raw_data_mode, and the line it starts on in the document.
+
+        The line is only known for RAW_DATA_MATCH.
+        """
+        if self.request is None or self.raw_data_mode == RAW_DATA_NONE:
+            return None, None
+        if self.raw_data_mode == RAW_DATA_TRUNCATE:
+            return self.raw_data[: max(self.raw_data_length, 0)], None
+        if self.raw_data_mode == RAW_DATA_RANGE:
+            # Slice the bytes, so that the rest of the document does not need to be decoded
+            return (
+                self.request.content[self.raw_data_start : self.raw_data_end].decode(
+                    self.encoding, "replace"
+                ),
+                None,
+            )
+        if self.raw_data_mode == RAW_DATA_MATCH:
+            try:
+                return self.matched_raw_data()
+            except Exception:
+                return None, None  # The error is reported as the parser_error
+        return self.raw_data, None
+
+    def matched_raw_data(self):
+        """Returns the source of the first match of the path and the line it starts on, None when it is not found."""
+        return None, None
+
+    @property
+    def profile(self):
+        """Returns the time spent in each stage of this request, and the size of the document"""
+        documents = list(self._documents.values())
+        return {
+            "timings_ms": {
+                stage: round(seconds * 1000, 3)
+                for stage, seconds in self.timings.items()
+            },
+            "document_bytes": (
+                len(self.request.content) if self.request is not None else None
+            ),
+            # Documents parsed in a worker process are not kept, so their nodes can not be counted
+            "node_count": count_nodes(documents[0]) if documents else None,
+        }
 
     @property
     def status_code(self):
         """Returns the status code from the request"""
-        return self.request.status_code
+        return self.request.status_code if self.request is not None else None
 
     @property
     def status_msg(self):
         """Returns information about the response code from the request"""
         return http_response_codes.get(self.status_code)
 
+    def __getstate__(self):
+        """Parsers sent to a worker process leave their parsed documents behind, and do not use the caches."""
+        state = self.__dict__.copy()
+        state["_documents"] = {}
+        state["cached_item"] = None
+        state["item"] = None
+        state["document_id"] = None
+        return state
+
+    def for_path(self, path, path_type):
+        """Returns a parser for another path in the document this parser has already fetched."""
+        parser = self.__class__(
+            url=self.__url,
+            path=path,
+            path_type=path_type,
+            user_agent=self.user_agent,
+            pretty=self.pretty,
+        )
+        parser.request = self.request
+        parser.error_code = self.error_code
+        parser.error_msg = self.error_msg
+        parser.cached_item = self.cached_item
+        parser.item = self.item
+        parser.coalesced = self.coalesced
+        parser.stale = self.stale
+        parser.document_id = self.document_id
+        parser._documents = self._documents
+        return parser
+
+    def _get_document(self, parse_mode, parse):
+        """Returns the document parsed by the parse function, reusing an earlier parse of the same cached response."""
+        if parse_mode in self._documents:
+            return self._documents[parse_mode]
+
+        if self.document_id is None:
+            with metrics.timer("parse", self.timings):
+                document = parse()
+        else:
+            key = (self.cache_key, parse_mode)
+            document = document_cache.get(key, self.document_id)
+            if document is None:
+                with metrics.timer("parse", self.timings):
+                    document = parse()
+                document_cache.set(
+                    key,
+                    self.document_id,
+                    document,
+                    size=len(self.request.content)
+                    * config.settings.document_cache_size_multiplier,
+                )
+        self._documents[parse_mode] = document
+        return document
+
     def _get_path_data(self):
         """Does the work of parsing the data from the document and returns the data."""
         raise NotImplementedError
 
     @classmethod
     def from_request_item(cls, request_item):
-        return cls(
+        parser = cls(
             url=request_item.url,
             path=request_item.path,
             path_type=request_item.path_type,
             user_agent=request_item.user_agent,
+            pretty=request_item.pretty,
+        )
+        parser.raw_data_mode = request_item.raw_data_mode
+        parser.raw_data_length = request_item.raw_data_length
+        parser.raw_data_start = request_item.raw_data_start
+        parser.raw_data_end = request_item.raw_data_end
+        return parser
+
+    @classmethod
+    def from_batch_request_item(cls, request_item):
+        return cls(
+            url=request_item.url,
+            path=None,
+            path_type=None,
+            user_agent=request_item.user_agent,
+            pretty=request_item.pretty,
         )
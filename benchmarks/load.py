@@ -0,0 +1,250 @@
+"""Load test of the /parsel and /dpath endpoints, with a local stub server standing in for the upstream web.
+
+Requests are sent to the app in this process at increasing concurrency, and the app fetches its documents from the
+stub server over a real connection. Each endpoint is tested with a cold request cache, where every request is for a
+new url, and with a warm request cache, where every url was requested before.
+
+Run from the root of the repo:
+
+    python -m benchmarks.load --concurrency 1 8 32 --requests 400 --latency-ms 50 --body-size 100KB
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import asyncio
+from datetime import datetime
+
+import httpx
+
+from app import config, metrics
+from app.main import app
+from app.util import cache
+from .parsers import SIZES, generate_html, generate_json, git_commit
+
+# name: (endpoint, stub document path, request params)
+TARGETS = {
+    "parsel": (
+        "/parsel",
+        "/document.html",
+        {"path": "//div[last()]/span/text()", "path_type": "XPATH"},
+    ),
+    "dpath": ("/dpath", "/document.json", {"path": "/catalog/title"}),
+}
+
+# Number of urls the warm cache scenario spreads its requests over
+WARM_URLS = 10
+
+
+class StubUpstream:
+    """A minimal HTTP/1.1 server with keep alive, that serves each document after a fixed latency."""
+
+    def __init__(self, documents, latency):
+        self.documents = documents
+        self.latency = latency
+        self.requests = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass  # The headers are not needed
+
+                self.requests += 1
+                path = request_line.split()[1].decode("latin-1").split("?")[0]
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                body = self.documents.get(path)
+                status = b"200 OK" if body is not None else b"404 Not Found"
+                body = body or b""
+                writer.write(
+                    b"HTTP/1.1 " + status + b"\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    b"Connection: keep-alive\r\n\r\n" + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def send_requests(client, endpoint, urls, params, concurrency):
+    """Sends a request for each url with at most concurrency in flight, returning the latencies and error count."""
+    latencies = []
+    errors = 0
+    pending = iter(urls)
+
+    async def worker():
+        nonlocal errors
+        for url in pending:
+            start = time.perf_counter()
+            response = await client.get(endpoint, params={**params, "url": url})
+            latencies.append(time.perf_counter() - start)
+            if (
+                response.status_code != 200
+                or response.json()["request_error"]["code"] != 200
+            ):
+                errors += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[
+        min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    ]
+
+
+async def run_scenario(client, stub, target, scenario, concurrency, request_count):
+    """Runs one scenario of a target at one concurrency, returning its latency percentiles and cache behavior."""
+    endpoint, document_path, params = TARGETS[target]
+    base_url = f"http://127.0.0.1:{stub.port}{document_path}"
+    run_id = f"{target}-{scenario}-{concurrency}-{time.monotonic_ns()}"
+    if scenario == "cold":
+        urls = [f"{base_url}?{run_id}-{index}" for index in range(request_count)]
+    else:
+        warm_urls = [f"{base_url}?{run_id}-{index}" for index in range(WARM_URLS)]
+        await send_requests(client, endpoint, warm_urls, params, concurrency)
+        urls = [warm_urls[index % WARM_URLS] for index in range(request_count)]
+
+    counters_before = dict(metrics.counters)
+    stub_requests_before = stub.requests
+    start = time.perf_counter()
+    latencies, errors = await send_requests(client, endpoint, urls, params, concurrency)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    counter_changes = {
+        name: metrics.counters[name] - counters_before.get(name, 0)
+        for name in ["request_cache_hits", "request_cache_misses", "coalesced_requests"]
+    }
+    return {
+        "target": target,
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "upstream_requests": stub.requests - stub_requests_before,
+        **counter_changes,
+    }
+
+
+async def run(args):
+    body_size = SIZES[args.body_size]
+    stub = StubUpstream(
+        documents={
+            "/document.html": generate_html(body_size),
+            "/document.json": generate_json(body_size),
+        },
+        latency=args.latency_ms / 1000,
+    )
+    await stub.start()
+
+    # Keep every warm url in the request cache for the whole run
+    config.settings.request_cache_max_len = max(
+        config.settings.request_cache_max_len, WARM_URLS * 2
+    )
+    cache.max_len = config.settings.request_cache_max_len
+
+    await app.router.startup()
+    results = []
+    try:
+        async with httpx.AsyncClient(app=app, base_url="http://load.test") as client:
+            for target in args.targets:
+                for scenario in args.scenarios:
+                    for concurrency in args.concurrency:
+                        result = await run_scenario(
+                            client, stub, target, scenario, concurrency, args.requests
+                        )
+                        results.append(result)
+                        print(
+                            f"{target:>7} {scenario:>5} c={concurrency:<4}"
+                            f" {result['requests_per_second']:9.1f} req/s"
+                            f"  p50 {result['p50_ms']:8.2f} ms"
+                            f"  p95 {result['p95_ms']:8.2f} ms"
+                            f"  p99 {result['p99_ms']:8.2f} ms"
+                            f"  upstream {result['upstream_requests']:>5}"
+                            f"  errors {result['errors']}"
+                        )
+    finally:
+        await app.router.shutdown()
+        await stub.close()
+    return results
+
+
+def main(argv=None):
+    argument_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argument_parser.add_argument(
+        "--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS)
+    )
+    argument_parser.add_argument(
+        "--scenarios", nargs="+", choices=["cold", "warm"], default=["cold", "warm"]
+    )
+    argument_parser.add_argument(
+        "--concurrency", nargs="+", type=int, default=[1, 4, 16, 64]
+    )
+    argument_parser.add_argument(
+        "--requests", type=int, default=500, help="Requests sent at each concurrency"
+    )
+    argument_parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=20,
+        help="Time the stub upstream waits before each response",
+    )
+    argument_parser.add_argument(
+        "--body-size",
+        choices=list(SIZES),
+        default="10KB",
+        help="Size of the documents the stub upstream serves",
+    )
+    argument_parser.add_argument("--output", default="benchmark_load.json")
+    args = argument_parser.parse_args(argv)
+
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+
+    with open(args.output, "w") as file:
+        json.dump(
+            {
+                "metadata": {
+                    "commit": git_commit(),
+                    "created": datetime.now().isoformat(),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "latency_ms": args.latency_ms,
+                    "body_size": args.body_size,
+                    "upstream_max_connections_per_host": config.settings.upstream_max_connections_per_host,
+                },
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nSaved the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
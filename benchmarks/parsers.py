@@ -0,0 +1,336 @@
+"""Micro-benchmarks of the document parsers, over generated HTML, JSON and XML documents from 1 KB to 100 MB.
+
+Each case selects a path from a document that is already in memory, the network is never used. The documents are
+parsed again for every run, the request and parsed document caches are not used.
+
+Run from the root of the repo, and compare the results with those of an earlier commit:
+
+    python -m benchmarks.parsers --max-size 10MB --output after.json --compare before.json
+
+Peak memory is measured two ways in separate runs of each case. tracemalloc counts the memory allocated by python,
+but not the memory libxml2 allocates for lxml trees. The peak resident memory of a new process that runs the case
+once counts both. It is reported along with how much the case raised that peak above the one reached while importing
+and generating the document, which is 0 when the case used less memory than generating the document did.
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tracemalloc
+import asyncio
+from datetime import datetime
+
+import httpx
+
+from app import config
+from app.util import parse_executor
+from app.routers.dpath import DpathDocumentParser
+from app.routers.parsel import ParselDocumentParser
+
+SIZES = {
+    "1KB": 1024,
+    "10KB": 10 * 1024,
+    "100KB": 100 * 1024,
+    "1MB": 1024 * 1024,
+    "10MB": 10 * 1024 * 1024,
+    "100MB": 100 * 1024 * 1024,
+}
+
+URL = "http://benchmark.invalid/document"
+
+
+def generate_html(size):
+    """Returns an HTML document of about size bytes, a list of items in divs."""
+    items = []
+    total = 0
+    index = 0
+    while total < size:
+        item = (
+            f'<div class="item" id="item-{index}"><span class="name">Item {index}</span>'
+            f'<a href="/items/{index}">Details of item {index}</a></div>\n'
+        )
+        items.append(item)
+        total += len(item)
+        index += 1
+    return (
+        "<html><head><title>Benchmark</title></head><body>\n"
+        + "".join(items)
+        + "</body></html>"
+    ).encode("utf-8")
+
+
+def generate_json(size):
+    """Returns a JSON document of about size bytes, a list of item objects."""
+    items = []
+    total = 0
+    index = 0
+    while total < size:
+        item = {
+            "id": index,
+            "name": f"Item {index}",
+            "tags": ["benchmark", f"tag-{index % 10}"],
+            "price": index * 1.5,
+        }
+        items.append(item)
+        total += len(json.dumps(item)) + 2
+        index += 1
+    return json.dumps({"catalog": {"title": "Benchmark", "items": items}}).encode(
+        "utf-8"
+    )
+
+
+def generate_xml(size):
+    """Returns an XML document of about size bytes, a list of item elements."""
+    items = []
+    total = 0
+    index = 0
+    while total < size:
+        item = (
+            f'<item id="{index}"><name>Item {index}</name><tag>tag-{index % 10}</tag>'
+            f"<price>{index * 1.5}</price></item>\n"
+        )
+        items.append(item)
+        total += len(item)
+        index += 1
+    return (
+        '<?xml version="1.0"?><catalog><title>Benchmark</title>\n'
+        + "".join(items)
+        + "</catalog>"
+    ).encode("utf-8")
+
+
+# name: (parser class, path_type, document generator, path, parser attributes)
+CASES = {
+    "xpath": (ParselDocumentParser, "XPATH", generate_html, "//title/text()", {}),
+    "xpath_last_item": (
+        ParselDocumentParser,
+        "XPATH",
+        generate_html,
+        "//div[last()]/span/text()",
+        {},
+    ),
+    "css": (ParselDocumentParser, "CSS", generate_html, "div.item span::text", {}),
+    "regex": (ParselDocumentParser, "REGEX", generate_html, r"Item (\d+)</span>", {}),
+    "json": (DpathDocumentParser, "JSON", generate_json, "/catalog/title", {}),
+    "json_glob": (
+        DpathDocumentParser,
+        "JSON",
+        generate_json,
+        "/catalog/items/0/na*",
+        {},
+    ),
+    "json_streaming": (
+        DpathDocumentParser,
+        "JSON",
+        generate_json,
+        "/catalog/title",
+        {"streaming": True},
+    ),
+    "xml": (DpathDocumentParser, "XML", generate_xml, "/catalog/title", {}),
+    "xml_lxml": (
+        DpathDocumentParser,
+        "XML",
+        generate_xml,
+        "/catalog/title",
+        {"xml_mode": "lxml"},
+    ),
+    "xml_streaming": (
+        DpathDocumentParser,
+        "XML",
+        generate_xml,
+        "/catalog/title",
+        {"streaming": True},
+    ),
+}
+
+
+def make_parser(case, content):
+    """Returns a parser for the case with the content as its response, as though it had been fetched."""
+    parser_class, path_type, _, path, attributes = CASES[case]
+    parser = parser_class(url=URL, path=path, path_type=path_type)
+    for name, value in attributes.items():
+        setattr(parser, name, value)
+    parser.request = httpx.Response(
+        200, content=content, request=httpx.Request("GET", URL)
+    )
+    return parser
+
+
+def select(case, content):
+    parser = make_parser(case, content)
+    asyncio.get_event_loop().run_until_complete(parser.select())
+    if parser.error_code:
+        raise RuntimeError(f"{case} failed: {parser.error_msg}")
+    return parser
+
+
+def peak_rss_bytes():
+    """Returns the peak resident memory of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KB
+
+
+def measure_rss(case, size):
+    """Runs the case once on a document of the size in a new process, returning its peak resident memory."""
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.parsers", "--rss-child", case, size],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def rss_child(case, size):
+    """Prints the peak resident memory of running the case, and how much the case raised it."""
+    content = CASES[case][2](SIZES[size])
+    before = peak_rss_bytes()
+    select(case, content)
+    after = peak_rss_bytes()
+    print(json.dumps({"peak_rss_bytes": after, "case_rss_bytes": after - before}))
+
+
+def run_case(case, content, repeat, min_seconds):
+    """Times selecting the path from the content, returning the result of the case."""
+    seconds = []
+    while len(seconds) < repeat or sum(seconds) < min_seconds:
+        start = time.perf_counter()
+        select(case, content)
+        seconds.append(time.perf_counter() - start)
+        if len(seconds) >= repeat and seconds[-1] > min_seconds:
+            break
+
+    tracemalloc.start()
+    select(case, content)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median_seconds = statistics.median(seconds)
+    return {
+        "case": case,
+        "path_type": CASES[case][1],
+        "path": CASES[case][3],
+        "document_bytes": len(content),
+        "runs": len(seconds),
+        "min_seconds": min(seconds),
+        "median_seconds": median_seconds,
+        "throughput_mb_per_second": len(content) / median_seconds / 1024 / 1024,
+        "peak_python_memory_bytes": peak_memory,
+    }
+
+
+def run_case_with_rss(case, size, content, repeat, min_seconds):
+    """Returns the result of the case, with the resident memory measured in a new process."""
+    result = run_case(case, content, repeat, min_seconds)
+    result["size"] = size
+    result.update(measure_rss(case, size))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_path):
+    """Prints the change in median time of each result from the matching result in an earlier results file."""
+    with open(previous_path) as file:
+        previous = {
+            (result["case"], result["size"]): result
+            for result in json.load(file)["results"]
+        }
+    print(f"\nCompared to {previous_path}:")
+    for result in results:
+        before = previous.get((result["case"], result["size"]))
+        if before is None:
+            continue
+        change = result["median_seconds"] / before["median_seconds"] - 1
+        print(f"{result['case']:>16} {result['size']:>6} {change:+8.1%}")
+
+
+def main(argv=None):
+    argument_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argument_parser.add_argument(
+        "--cases", nargs="+", choices=list(CASES), default=list(CASES)
+    )
+    argument_parser.add_argument("--max-size", choices=list(SIZES), default="100MB")
+    argument_parser.add_argument(
+        "--repeat", type=int, default=5, help="Least number of runs of each case"
+    )
+    argument_parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.5,
+        help="Keep running a case until it has run this long",
+    )
+    argument_parser.add_argument("--output", default="benchmark_parsers.json")
+    argument_parser.add_argument(
+        "--compare", help="A results file from an earlier run to compare with"
+    )
+    # Used by measure_rss() to run a single case in a new process
+    argument_parser.add_argument(
+        "--rss-child", nargs=2, metavar=("CASE", "SIZE"), help=argparse.SUPPRESS
+    )
+    args = argument_parser.parse_args(argv)
+
+    # Parse inline so the parse is timed on its own, rather than along with handing it to a pool
+    config.settings.parse_executor = "none"
+    parse_executor.start()
+
+    if args.rss_child:
+        rss_child(*args.rss_child)
+        return
+
+    sizes = list(SIZES)[: list(SIZES).index(args.max_size) + 1]
+    results = []
+    for generate in dict.fromkeys(CASES[case][2] for case in args.cases):
+        for size in sizes:
+            content = generate(SIZES[size])
+            for case in args.cases:
+                if CASES[case][2] is not generate:
+                    continue
+                result = run_case_with_rss(
+                    case, size, content, args.repeat, args.min_seconds
+                )
+                results.append(result)
+                print(
+                    f"{case:>16} {size:>6} {result['median_seconds'] * 1000:12.3f} ms"
+                    f" {result['throughput_mb_per_second']:10.1f} MB/s"
+                    f" {result['peak_python_memory_bytes'] / 1024 / 1024:10.1f} MB python peak"
+                    f" {result['case_rss_bytes'] / 1024 / 1024:10.1f} MB resident"
+                )
+
+    with open(args.output, "w") as file:
+        json.dump(
+            {
+                "metadata": {
+                    "commit": git_commit(),
+                    "created": datetime.now().isoformat(),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                },
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nSaved the results to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
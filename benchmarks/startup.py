@@ -0,0 +1,174 @@
+"""Cold start benchmark of the app, each run in a new python process as it would be on a server that was asleep.
+
+Every run times importing app.main, starting the app, its first request to /wake, its first parse of a document
+with the /parsel and /dpath parsers, and generating the OpenAPI schema for the docs. The modules that take longest
+to import are listed from an extra run with `python -X importtime`.
+
+Run from the root of the repo, and compare the results with those of an earlier commit:
+
+    python -m benchmarks.startup --runs 20 --output after.json --compare before.json
+"""
+
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+
+from .parsers import git_commit
+
+# Run in each new process, prints the seconds each stage of the cold start took as JSON
+CHILD_SCRIPT = """
+import json
+import time
+import asyncio
+
+timings = {}
+start = time.perf_counter()
+import app.main
+timings["import"] = time.perf_counter() - start
+
+import httpx
+from app.routers.dpath import DpathDocumentParser
+from app.routers.parsel import ParselDocumentParser
+from app.routers.examples import DocumentExamples
+
+
+async def cold_start():
+    start = time.perf_counter()
+    await app.main.app.router.startup()
+    timings["startup"] = time.perf_counter() - start
+
+    async with httpx.AsyncClient(app=app.main.app, base_url="http://startup.test") as client:
+        start = time.perf_counter()
+        await client.get("/wake")
+        timings["first_request"] = time.perf_counter() - start
+
+    for name, parser, content in [
+        ("first_parsel_parse", ParselDocumentParser("http://startup.test/", "//title/text()", "XPATH"),
+         DocumentExamples.HTML.encode()),
+        ("first_dpath_parse", DpathDocumentParser("http://startup.test/", "/note/to", "XML"),
+         DocumentExamples.XML.encode()),
+    ]:
+        parser.request = httpx.Response(200, content=content)
+        start = time.perf_counter()
+        await parser.select()
+        timings[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app.main.app.openapi()
+    timings["openapi"] = time.perf_counter() - start
+    await app.main.app.router.shutdown()
+
+
+asyncio.get_event_loop().run_until_complete(cold_start())
+print(json.dumps(timings))
+"""
+
+
+def run_once():
+    """Returns the seconds each stage of a cold start took, in a new python process."""
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT], capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(count):
+    """Returns the modules with the longest cumulative import time when importing app.main, in microseconds."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            imports.append((module.strip(), int(cumulative)))
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return [
+        {"module": module, "cumulative_microseconds": microseconds}
+        for module, microseconds in imports[:count]
+    ]
+
+
+def compare(results, previous_path):
+    """Prints the change in median time of each stage from an earlier results file."""
+    with open(previous_path) as file:
+        previous = json.load(file)["results"]
+    print(f"\nCompared to {previous_path}:")
+    for stage, result in results.items():
+        before = previous.get(stage)
+        if before is None:
+            continue
+        change = result["median_seconds"] / before["median_seconds"] - 1
+        print(f"{stage:>20} {change:+8.1%}")
+
+
+def main(argv=None):
+    argument_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argument_parser.add_argument(
+        "--runs", type=int, default=10, help="Number of new processes to time"
+    )
+    argument_parser.add_argument(
+        "--top-imports",
+        type=int,
+        default=15,
+        help="Number of the slowest imports to list",
+    )
+    argument_parser.add_argument("--output", default="benchmark_startup.json")
+    argument_parser.add_argument(
+        "--compare", help="A results file from an earlier run to compare with"
+    )
+    args = argument_parser.parse_args(argv)
+
+    runs = [run_once() for _ in range(args.runs)]
+    runs = [{**timings, "total": sum(timings.values())} for timings in runs]
+    results = {}
+    for stage in runs[0]:
+        seconds = [timings[stage] for timings in runs]
+        results[stage] = {
+            "min_seconds": min(seconds),
+            "median_seconds": statistics.median(seconds),
+            "max_seconds": max(seconds),
+        }
+        print(
+            f"{stage:>20} {results[stage]['median_seconds'] * 1000:10.1f} ms median"
+            f" {results[stage]['min_seconds'] * 1000:10.1f} ms min"
+        )
+
+    imports = slowest_imports(args.top_imports)
+    print("\nSlowest imports:")
+    for entry in imports:
+        print(f"{entry['cumulative_microseconds'] / 1000:10.1f} ms {entry['module']}")
+
+    with open(args.output, "w") as file:
+        json.dump(
+            {
+                "metadata": {
+                    "commit": git_commit(),
+                    "created": datetime.now().isoformat(),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "runs": args.runs,
+                },
+                "results": results,
+                "slowest_imports": imports,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nSaved the results to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()